@@ -18,6 +18,10 @@ within dir! If you cloned/downloaded the repo, this is taken care of.
     mechanize
     tqdm
     
+    optional:
+    zstandard          (html archive shards use zstd instead of gzip)
+    pyarrow            (cleaned bags are saved as parquet instead of csv)
+    
     lxml + cchardet *dramatically* speeds up the parsing. Installing Visual C++
     was necessary on my Windows machine to install cchardet and get the full 
     benefits.
@@ -43,6 +47,26 @@ update_to   = 2024
 # I usually lag given examination/approval lags
 output_to   = update_to-3                           
 
+# fused mode: parse pages as they download instead of writing all the html
+# and then rereading it. keep_html=False doesn't save the raw html at all
+fused_DL_parse = False
+keep_html      = True
+
+# processes to use for the CPU heavy steps (parsing, etc.)
+n_workers = 8
+
+# memory budget (bytes) for cleaning and for the measures (leave headroom)
+max_memory = 24*1024**3
+
+# cleaned bags are parquet; also write the old bag_ayear_<YYYY>.csv (for Stata)?
+cleaned_bags_csv = False
+
+# incremental: only add the newly parsed patents (late grants) to years that 
+# were already cleaned (a year whose stopwords change is still cleaned in full).
+# RETech then copies the years that didn't change from previous_output_dir 
+previous_output_dir = None # e.g. 'outputs 2024-02'
+incremental         = previous_output_dir is not None
+
 ##########################
 # OK, LET'S DO THIS
 ##########################
@@ -60,12 +84,19 @@ GPGutils.update_pat_dates(update_to)
 GPGutils.update_pat_nber_class()  
 
 # DL, parse to raw bags, clean into annual bags 
-GPGutils.download_patent_HTML(update_from,update_to)  
+# (what's on disk is tracked in data/manifest.sqlite. if you moved or deleted 
+# html/bag files by hand, run GPGutils.rebuild_manifest() first. raw bags from
+# before the packed bag store can be migrated once with GPGutils.pack_raw_bags())
+if fused_DL_parse:
+    GPGutils.download_and_parse(update_from,update_to,keep_html=keep_html)
+else:
+    GPGutils.download_patent_HTML(update_from,update_to)  
 
-GPGutils.parse_bags(update_from,update_to)  
-    # if error: use delete_recent_raw_bags(), then restart update_bags()
+GPGutils.parse_bags(update_from,update_to,n_workers=n_workers)  
+    # if it dies or is killed: just rerun, the unfinished batch is rolled back
 
-GPGutils.clean_bags(update_from,update_to)  
+GPGutils.clean_bags(update_from,update_to,n_workers=n_workers,max_memory=max_memory,
+                    write_csv=cleaned_bags_csv,incremental=incremental)  
 
 # create the measures and stitch together
 if os.path.exists('../'+output_dir+'/'):
@@ -73,9 +104,10 @@ if os.path.exists('../'+output_dir+'/'):
     print('overwrite existing prior outputs. Or maybe not. Idk.')
 else:
     
-    GPGutils.make_RETech('../'+output_dir_name+'/RETech.csv',end=output_to)  
-        
-    GPGutils.make_breadth('../'+output_dir_name+'/Breadth.csv',end=output_to)     
+    # RETech.csv and Breadth.csv (and any other registered measures), 
+    # reading each year's bags once 
+    GPGutils.make_measures('../'+output_dir_name,end=output_to,max_memory=max_memory,n_workers=n_workers,
+                           previous_dir=('../'+previous_output_dir if previous_output_dir else None))  
     
     GPGutils.ship_outputs(output_dir_name)
     
@@ -90,6 +90,7 @@ def update_pat_dates(max_year=2020,min_year=2000,
 
     '''
     
+    import shutil
     import pandas as pd
         
     print('update_pat_dates now downloading large patent files...')
@@ -147,7 +148,7 @@ def update_pat_dates(max_year=2020,min_year=2000,
         
     # merge this with the existing dates, save update and the prior, as backup.
     
-    existing_years = pd.read_csv('../data/patent_level_info/pat_dates_CURRENT.csv')
+    existing_years = PatentMeta().dates()
         
     updated_years = (existing_years.merge(new_years,on='pnum',
                                          how='outer',validate='1:1',
@@ -162,7 +163,8 @@ def update_pat_dates(max_year=2020,min_year=2000,
     
     updated_years = updated_years.astype(int) # no floats! 
              
-    existing_years.to_csv('../data/patent_level_info/pat_dates_PRIOR.csv',index=False)
+    shutil.copyfile('../data/patent_level_info/pat_dates_CURRENT.csv',
+                    '../data/patent_level_info/pat_dates_PRIOR.csv')
     updated_years.to_csv('../data/patent_level_info/pat_dates_CURRENT.csv',index=False)
     
     
@@ -230,6 +232,148 @@ def update_pat_nber_class(cpc_url = 'https://s3.amazonaws.com/data.patentsview.o
     nber.to_csv('../data/patent_level_info/nber_CURRENT.csv',index=False)    
    
    
+class PatentMeta:
+    """
+    The patent level info in pat_dates_CURRENT.csv and nber_CURRENT.csv as 
+    numpy arrays in data/patent_level_info/meta/, which are memory mapped, 
+    so a stage doesn't parse the csvs (and processes share the pages):
+        
+        ayear.npy, gyear.npy         int16, indexed by pnum (0: the pnum is
+                                     not in pat_dates_CURRENT.csv)
+        nber_pnum.npy, nber_code.npy sorted by pnum, rows with no code 
+                                     dropped (a patent can have several)
+    
+    Each pair is rebuilt from its csv the first time it's used after the csv
+    changes (the csv's mtime is kept in meta/<csv name>.mtime), so 
+    update_pat_dates() and update_pat_nber_class() only write the csvs.
+    
+        pnums_for_ayears(lo, hi)  - pnums applied for in [lo, hi], sorted
+        lookup(pnums)             - their ayear, gyear and nber
+        dates()                   - all of pat_dates_CURRENT.csv
+        nber()                    - (pnums, codes), see load_nber_arrays
+    """
+    
+    SOURCES = {'pat_dates_CURRENT.csv': ('ayear','gyear'),
+               'nber_CURRENT.csv':      ('nber_pnum','nber_code')}
+    
+    def __init__(self, info_dir='../data/patent_level_info'):
+        import os
+        self.info_dir = info_dir
+        self.meta_dir = os.path.join(info_dir, 'meta')
+        self.arrays   = {} # name: memmap
+    
+    def stamp(self, source):
+        'mtime of the csv, None if there is no csv'
+        import os
+        fname = os.path.join(self.info_dir, source)
+        return str(os.path.getmtime(fname)) if os.path.exists(fname) else None
+    
+    def is_current(self, source):
+        import os
+        fname = os.path.join(self.meta_dir, source + '.mtime')
+        if not os.path.exists(fname):
+            return False
+        with open(fname) as f:
+            return f.read() == self.stamp(source)
+    
+    def build(self, source):
+        'Rewrite the arrays of a csv (to .tmp files, then renamed)'
+        import os
+        import numpy as np
+        import pandas as pd
+        
+        if source == 'pat_dates_CURRENT.csv':
+            dates  = pd.read_csv(os.path.join(self.info_dir, source), usecols=['pnum','ayear','gyear'])
+            pnums  = dates.pnum.values
+            arrays = []
+            for col in ('ayear','gyear'):
+                arr = np.zeros(pnums.max()+1 if len(pnums) else 0, dtype=np.int16)
+                arr[pnums] = dates[col].fillna(0).values
+                arrays.append(arr)
+        else:
+            nber   = pd.read_csv(os.path.join(self.info_dir, source)).dropna().sort_values('pnum', kind='stable')
+            arrays = [nber.iloc[:,0].values, nber.iloc[:,1].values]
+        
+        os.makedirs(self.meta_dir, exist_ok=True)
+        tmp = '.%i.tmp' % os.getpid() # two processes can build at once
+        for name, arr in zip(self.SOURCES[source], arrays):
+            path = os.path.join(self.meta_dir, name + '.npy')
+            with open(path + tmp, 'wb') as f:
+                np.save(f, arr)
+            os.replace(path + tmp, path)
+            self.arrays.pop(name, None)
+        path = os.path.join(self.meta_dir, source + '.mtime')
+        with open(path + tmp, 'w') as f:
+            f.write(self.stamp(source))
+        os.replace(path + tmp, path)
+    
+    def refresh(self):
+        'Rebuild the arrays of any csv that changed (before starting workers)'
+        for source in self.SOURCES:
+            if self.stamp(source) is not None and not self.is_current(source):
+                self.build(source)
+    
+    def load(self, source):
+        'The arrays of a csv, memory mapped'
+        import os
+        import numpy as np
+        names = self.SOURCES[source]
+        if names[0] not in self.arrays:
+            if not self.is_current(source):
+                self.build(source)
+            for name in names:
+                self.arrays[name] = np.load(os.path.join(self.meta_dir, name + '.npy'), mmap_mode='r')
+        return tuple(self.arrays[name] for name in names)
+    
+    def nber(self):
+        return self.load('nber_CURRENT.csv')
+    
+    def pnums_for_ayears(self, lo, hi):
+        import numpy as np
+        ayear, _ = self.load('pat_dates_CURRENT.csv')
+        return np.flatnonzero((ayear >= lo) & (ayear <= hi))
+    
+    def dates(self):
+        'DataFrame (pnum, ayear, gyear) of the patents in pat_dates_CURRENT.csv'
+        import numpy as np
+        import pandas as pd
+        ayear, gyear = self.load('pat_dates_CURRENT.csv')
+        pnums = np.flatnonzero(ayear)
+        return pd.DataFrame({'pnum': pnums, 'ayear': ayear[pnums].astype(np.int64), 
+                             'gyear': gyear[pnums].astype(np.int64)})
+    
+    def lookup(self, pnums):
+        '''
+        DataFrame (pnum, ayear, gyear, nber) for pnums, in their order. 
+        Missing values are <NA> (all of them if the csv doesn't exist, e.g.
+        parse_bags() before update_pat_nber_class()), and a patent with 
+        several nber codes gets the first one.
+        '''
+        import numpy as np
+        import pandas as pd
+        
+        pnums = np.asarray(pnums, dtype=np.int64)
+        out   = pd.DataFrame({'pnum': pnums})
+        
+        ayear, gyear = (self.load('pat_dates_CURRENT.csv') if self.stamp('pat_dates_CURRENT.csv')
+                        else (np.zeros(0, dtype=np.int16),)*2)
+        inside       = (pnums >= 0) & (pnums < len(ayear))
+        for col, arr in (('ayear', ayear), ('gyear', gyear)):
+            years = np.zeros(len(pnums), dtype=np.int64)
+            years[inside] = arr[pnums[inside]]
+            out[col] = pd.arrays.IntegerArray(years, years == 0)
+        
+        nber_pnums, codes = (self.nber() if self.stamp('nber_CURRENT.csv') 
+                             else (np.zeros(0, dtype=np.int64), np.zeros(0)))
+        at    = np.searchsorted(nber_pnums, pnums) # the first code
+        found = at < len(nber_pnums)
+        found[found] = nber_pnums[at[found]] == pnums[found]
+        nber  = np.zeros(len(pnums), dtype=np.int64)
+        nber[found] = codes[at[found]]
+        out['nber'] = pd.arrays.IntegerArray(nber, ~found)
+        return out
+
+
 def download_gpg_pages_OLD(list_of_patent_nums,num_fetch_threads=20):
     """
     Downloads Google Patent pages for utility patents by iterating over the 
@@ -352,15 +496,576 @@ def download_gpg_pages_OLD(list_of_patent_nums,num_fetch_threads=20):
     print("Elapsed seconds (rounded up): %d" %(end-start+1))
     print("Elapsed minutes (rounded up): %d" %((end-start)/60+1))
 
-def download_gpg_pages(patent_nums):
+class AIMDController:
+    """
+    Additive-increase/multiplicative-decrease control of the number of 
+    requests the downloader keeps in flight (same idea as TCP congestion 
+    control).
+    
+    While responses come back 200 and faster than latency_target seconds, 
+    the window grows by about `increase` per window's worth of successes. 
+    On a 429/503/timeout the window is multiplied by `decrease` (at most once
+    per `cooldown` seconds, so a burst of failures from one overload only 
+    counts once) and any Retry-After pause is honored.
+    """
+    
+    def __init__(self, start=10, floor=1, ceiling=200, increase=1.0, 
+                 decrease=0.5, latency_target=5.0, cooldown=5.0):
+        self.window         = float(start)
+        self.floor          = floor
+        self.ceiling        = ceiling
+        self.increase       = increase
+        self.decrease       = decrease
+        self.latency_target = latency_target
+        self.cooldown       = cooldown
+        self.last_cut       = float('-inf')
+        self.pause_until    = float('-inf')
+    
+    @property
+    def limit(self):
+        'The number of requests allowed in flight right now'
+        return int(max(self.floor, min(self.ceiling, self.window)))
+    
+    def on_success(self, latency):
+        if latency <= self.latency_target:
+            self.window = min(self.ceiling, self.window + self.increase / self.window)
+    
+    def on_congestion(self, retry_after=None):
+        import time
+        now = time.monotonic()
+        if now - self.last_cut >= self.cooldown:
+            self.window   = max(self.floor, self.window * self.decrease)
+            self.last_cut = now
+        if retry_after:
+            self.pause_until = max(self.pause_until, now + retry_after)
+    
+    @staticmethod
+    def parse_retry_after(value):
+        'Retry-After is either a number of seconds or an HTTP date'
+        from datetime import datetime, timezone
+        from email.utils import parsedate_to_datetime
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) 
+                             - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+class RetryLedger:
+    """
+    Persistent record of pnums whose download failed, so they are retried 
+    (with exponential backoff) instead of being lost until the next full 
+    rescan. 
+    
+    Stored as a csv with columns pnum, attempts, next_try (unix time), 
+    last_status. A pnum leaves the ledger once it downloads. After 
+    max_attempts failures it stays in the ledger but is skipped (look at 
+    last_status to see why, e.g. 404s for withdrawn patents).
+    
+    due() only offers pnums that failed since the ledger was loaded (this 
+    run), the other entries wait for a run that asks for them again.
+    """
+    
+    def __init__(self, path='../data/html_retry_ledger.csv', base_delay=30, 
+                 max_delay=7*24*3600, max_attempts=8):
+        import os, csv
+        self.path         = path
+        self.base_delay   = base_delay
+        self.max_delay    = max_delay
+        self.max_attempts = max_attempts
+        self.entries      = {} # pnum: [attempts, next_try, last_status]
+        self.in_queue     = set() # pnums handed to workers, not back yet
+        self.failed       = set() # pnums that failed in this run
+        
+        if os.path.exists(path):
+            with open(path, 'r', newline='') as f_csv:
+                for row in csv.DictReader(f_csv):
+                    self.entries[int(row['pnum'])] = [int(row['attempts']),
+                                                      float(row['next_try']),
+                                                      row['last_status']]
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def ready(self, pnum):
+        'False if pnum is backing off, given up on, or already queued'
+        import time
+        if pnum in self.in_queue:
+            return False
+        if pnum not in self.entries:
+            return True
+        attempts, next_try, _ = self.entries[pnum]
+        return attempts < self.max_attempts and next_try <= time.time()
+    
+    def due(self, horizon=0):
+        'Pnums that failed in this run and can be retried within horizon seconds'
+        import time
+        cutoff = time.time() + horizon
+        return [pnum for pnum in sorted(self.failed)
+                if self.entries[pnum][0] < self.max_attempts and self.entries[pnum][1] <= cutoff
+                and pnum not in self.in_queue]
+    
+    def record_failure(self, pnum, status):
+        import time
+        self.in_queue.discard(pnum)
+        self.failed.add(pnum)
+        attempts = self.entries.get(pnum, [0])[0] + 1
+        delay    = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        self.entries[pnum] = [attempts, time.time() + delay, str(status)]
+    
+    def record_success(self, pnum):
+        self.in_queue.discard(pnum)
+        self.failed.discard(pnum)
+        self.entries.pop(pnum, None)
+    
+    def save(self):
+        'Atomic rewrite, so a crash never leaves a half written ledger'
+        import os, csv
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w', newline='') as f_csv:
+            out_csv = csv.writer(f_csv)
+            out_csv.writerow(['pnum', 'attempts', 'next_try', 'last_status'])
+            for pnum, (attempts, next_try, status) in sorted(self.entries.items()):
+                out_csv.writerow([pnum, attempts, next_try, status])
+        os.replace(self.path + '.tmp', self.path)
+        
+
+class HTMLArchive:
+    """
+    Compressed, sharded store for the raw GPG html within one 
+    data/html_DL_in_<YYYY> folder. 
+    
+    Instead of <stem>/html_<pnum>.txt (one uncompressed file per patent), 
+    pages are appended as independent compressed members to one shard per 
+    stem, <stem>.html.zst (if the zstandard package is installed) or 
+    <stem>.html.gz, and <shard>.idx records "pnum,offset,length" so any page 
+    can be read back without touching the rest of the shard. This is ~5-10x 
+    smaller and turns tens of millions of files into a few thousand.
+    
+    Reads fall back to the legacy per patent .txt files, so folders 
+    downloaded before this existed (or partly converted ones) still work. 
+    Writes are append only and the index line is written after the data, so
+    a crash can only leave unindexed (ignored) bytes at the end of a shard. 
+    Only one process should write to a given folder at a time.
+    """
+    
+    CODECS = ('.html.zst', '.html.gz')
+    
+    _by_year = {} # see for_year()
+    
+    def __init__(self, year_dir):
+        self.year_dir = year_dir
+        self.indexes  = {} # stem: {pnum: (shard path, offset, length)}
+        try:
+            import zstandard
+            self.write_ext = '.html.zst'
+        except ImportError:
+            self.write_ext = '.html.gz'
+    
+    @classmethod
+    def for_year(cls, year_of_DL):
+        'Shared instance for data/html_DL_in_<year_of_DL>, so indexes load once'
+        if year_of_DL not in cls._by_year:
+            cls._by_year[year_of_DL] = cls(f'../data/html_DL_in_{year_of_DL}')
+        return cls._by_year[year_of_DL]
+    
+    @staticmethod
+    def stem(pnum):
+        # pnum  8,123,456  --> eight digits: 08123456 --> stem 0812
+        return str(pnum).zfill(8)[:4]
+    
+    def legacy_path(self, pnum):
+        return '%s/%s/html_%i.txt' % (self.year_dir, self.stem(pnum), pnum)
+    
+    def index(self, stem):
+        'Load (and cache) the offset index of all shards for a stem'
+        import os
+        if stem not in self.indexes:
+            idx = {}
+            for ext in self.CODECS:
+                shard = os.path.join(self.year_dir, stem + ext)
+                if os.path.exists(shard + '.idx'):
+                    with open(shard + '.idx', 'r') as f:
+                        for line in f:
+                            pnum, offset, length = line.split(',')
+                            idx[int(pnum)] = (shard, int(offset), int(length))
+            self.indexes[stem] = idx
+        return self.indexes[stem]
+    
+    def has(self, pnum):
+        import os
+        return (pnum in self.index(self.stem(pnum)) 
+                or os.path.exists(self.legacy_path(pnum)))
+    
+    def read(self, pnum):
+        'Returns the page as bytes, or None if we don\'t have it'
+        import os
+        entry = self.index(self.stem(pnum)).get(pnum)
+        if entry is None:
+            if os.path.exists(self.legacy_path(pnum)):
+                with open(self.legacy_path(pnum), 'rb') as f:
+                    return f.read()
+            return None
+        shard, offset, length = entry
+        with open(shard, 'rb') as f:
+            f.seek(offset)
+            member = f.read(length)
+        if shard.endswith('.zst'):
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(member)
+        import gzip
+        return gzip.decompress(member)
+    
+    def write(self, pnum, content):
+        import os
+        if self.write_ext == '.html.zst':
+            import zstandard
+            member = zstandard.ZstdCompressor(level=10).compress(content)
+        else:
+            import gzip
+            member = gzip.compress(content, compresslevel=6)
+        stem  = self.stem(pnum)
+        shard = os.path.join(self.year_dir, stem + self.write_ext)
+        os.makedirs(self.year_dir, exist_ok=True)
+        with open(shard, 'ab') as f:
+            offset = f.tell()
+            f.write(member)
+        with open(shard + '.idx', 'a') as f:
+            f.write('%i,%i,%i\n' % (pnum, offset, len(member)))
+        self.index(stem)[pnum] = (shard, offset, len(member))
+        return len(member)
+    
+    def pnums(self):
+        'All pnums in the shards of this folder (not the legacy files)'
+        import os
+        if not os.path.exists(self.year_dir):
+            return set()
+        stems = {f.split('.')[0] for f in os.listdir(self.year_dir) 
+                 if f.endswith('.idx')}
+        return {pnum for stem in stems for pnum in self.index(stem)}
+
+
+def archive_html_files(year_of_DL, delete_files=True):
+    """
+    One-time conversion of a data/html_DL_in_<YYYY> folder from one .txt 
+    file per patent into HTMLArchive shards. 
+    
+    Files are deleted (if delete_files) only after their stem has been 
+    written to the shard. Safe to rerun if interrupted: pages already in a
+    shard are skipped.
+    """
+    
+    import os
+    from tqdm import tqdm
+    
+    archive = HTMLArchive(f'../data/html_DL_in_{year_of_DL}')
+    stems   = sorted(d for d in os.listdir(archive.year_dir) 
+                     if os.path.isdir(os.path.join(archive.year_dir, d)))
+    
+    for stem in tqdm(stems, desc=f'Archiving html DLed in {year_of_DL}'):
+        stem_dir = os.path.join(archive.year_dir, stem)
+        files    = [f for f in os.listdir(stem_dir) if f.startswith('html_')]
+        for fname in files:
+            pnum = int(fname[5:-4])
+            if pnum not in archive.index(stem):
+                with open(os.path.join(stem_dir, fname), 'rb') as f:
+                    archive.write(pnum, f.read())
+        if delete_files:
+            for fname in files:
+                os.remove(os.path.join(stem_dir, fname))
+            os.rmdir(stem_dir)
+        
+
+class Manifest:
+    """
+    SQLite index of what we have on disk, so "what needs downloading or 
+    parsing for ayears X-Y" is one indexed query instead of find/listdir 
+    scans over millions of files. Lives in data/manifest.sqlite.
+    
+    Tables:
+        patents (pnum, ayear)     
+            mirror of pat_dates_CURRENT.csv, reloaded when that file changes
+        html    (pnum, year_of_DL, nbytes, sha1)   
+            one row per downloaded page, nbytes is the size on disk 
+            (compressed if in an HTMLArchive shard), sha1 is of the raw page
+        bags    (pnum, status, year_of_DL, bag_path, row_start, row_stop)   
+            status is 'parsed' (bag_path is relative to data/word_bags) or 
+            'failed' (no description found, will be retried). For bags in a
+            RawBagStore shard, the patent's rows are [row_start, row_stop)
+    
+    The downloader and parse_bags record rows as they write files. If the 
+    manifest is missing, it is built from disk the first time it's opened. 
+    If it ever gets out of sync (e.g. files were moved or deleted by hand), 
+    run rebuild_manifest().
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS patents (pnum INTEGER PRIMARY KEY, ayear INTEGER);
+        CREATE INDEX IF NOT EXISTS patents_ayear ON patents (ayear);
+        CREATE TABLE IF NOT EXISTS html (pnum INTEGER, year_of_DL INTEGER, 
+                                         nbytes INTEGER, sha1 TEXT,
+                                         PRIMARY KEY (pnum, year_of_DL));
+        CREATE TABLE IF NOT EXISTS bags (pnum INTEGER PRIMARY KEY, status TEXT, 
+                                         year_of_DL INTEGER, bag_path TEXT,
+                                         row_start INTEGER, row_stop INTEGER);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        '''
+    
+    def __init__(self, path='../data/manifest.sqlite', data_dir='../data', 
+                 flush_every=1000, build_if_new=True):
+        import os, sqlite3
+        is_new = not os.path.exists(path)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path        = path
+        self.data_dir    = data_dir
+        self.flush_every = flush_every
+        self.pending     = {'html': [], 'bags': []}
+        self.con         = sqlite3.connect(path)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.executescript(self.SCHEMA)
+        if 'row_start' not in [col[1] for col in self.con.execute('PRAGMA table_info(bags)')]:
+            with self.con: # manifest from before RawBagStore
+                self.con.execute('ALTER TABLE bags ADD COLUMN row_start INTEGER')
+                self.con.execute('ALTER TABLE bags ADD COLUMN row_stop INTEGER')
+        if is_new and build_if_new:
+            print('No manifest yet, building it from files on disk (one time)')
+            self.rebuild()
+        self.refresh_pat_dates()
+    
+    # ----- writing ----- #
+    
+    def record_html(self, pnum, year_of_DL, nbytes=None, sha1=None):
+        self.pending['html'].append((int(pnum), int(year_of_DL), nbytes, sha1))
+        if len(self.pending['html']) >= self.flush_every:
+            self.flush()
+    
+    def record_bag(self, pnum, status, year_of_DL=None, bag_path=None, 
+                   row_start=None, row_stop=None):
+        self.pending['bags'].append((int(pnum), status, year_of_DL, bag_path, 
+                                     row_start, row_stop))
+        if len(self.pending['bags']) >= self.flush_every:
+            self.flush()
+    
+    def flush(self):
+        'Commit pending records (one transaction, not one per file)'
+        with self.con:
+            # keep known sizes/hashes if a re-record doesn't have them 
+            self.con.executemany('''
+                INSERT INTO html VALUES (?,?,?,?)
+                ON CONFLICT (pnum, year_of_DL) DO UPDATE SET
+                    nbytes = coalesce(excluded.nbytes, nbytes),
+                    sha1   = coalesce(excluded.sha1, sha1)''', self.pending['html'])
+            self.con.executemany('INSERT OR REPLACE INTO bags VALUES (?,?,?,?,?,?)',
+                                 self.pending['bags'])
+        self.pending = {'html': [], 'bags': []}
+    
+    def drop_bags(self, pnums):
+        self.flush()
+        with self.con:
+            self.con.executemany('DELETE FROM bags WHERE pnum = ?', 
+                                 [(int(p),) for p in pnums])
+    
+    def refresh_pat_dates(self):
+        'Reload the patents table if pat_dates_CURRENT.csv changed'
+        import os
+        import numpy as np
+        meta  = PatentMeta(os.path.join(self.data_dir,'patent_level_info'))
+        stamp = meta.stamp('pat_dates_CURRENT.csv')
+        if stamp is None:
+            return
+        if self.con.execute("SELECT value FROM meta WHERE key = 'pat_dates_mtime'").fetchone() == (stamp,):
+            return
+        ayear, _ = meta.load('pat_dates_CURRENT.csv')
+        pnums    = np.flatnonzero(ayear)
+        with self.con:
+            self.con.execute('DELETE FROM patents')
+            self.con.executemany('INSERT INTO patents VALUES (?,?)',
+                                 zip(pnums.tolist(), ayear[pnums].tolist()))
+            self.con.execute("INSERT OR REPLACE INTO meta VALUES ('pat_dates_mtime', ?)", (stamp,))
+    
+    # ----- reading ----- #
+    
+    def to_download(self, min_year, max_year, skip_parsed=False):
+        '''
+        Pnums applied for in [min_year, max_year] with no html anywhere (and,
+        if skip_parsed, no bag either, for when the html wasn't kept)
+        '''
+        self.flush()
+        return [r[0] for r in self.con.execute('''
+            SELECT pnum FROM patents p
+            WHERE ayear BETWEEN ? AND ? 
+              AND NOT EXISTS (SELECT 1 FROM html h WHERE h.pnum = p.pnum)
+              AND NOT (? AND EXISTS (SELECT 1 FROM bags b 
+                                     WHERE b.pnum = p.pnum AND b.status = 'parsed'))
+            ORDER BY pnum''', (min_year, max_year, skip_parsed))]
+    
+    def to_parse(self, min_year, max_year):
+        '''
+        [pnum, year_of_DL, ayear] for pnums applied for in [min_year, max_year]
+        with html but no bag. If a pnum was DLed in several years, use the 
+        latest download.
+        '''
+        self.flush()
+        return self.con.execute('''
+            SELECT p.pnum, max(h.year_of_DL), p.ayear FROM patents p 
+            JOIN html h ON h.pnum = p.pnum
+            WHERE p.ayear BETWEEN ? AND ?
+              AND NOT EXISTS (SELECT 1 FROM bags b 
+                              WHERE b.pnum = p.pnum AND b.status = 'parsed')
+            GROUP BY p.pnum ORDER BY p.pnum''', (min_year, max_year)).fetchall()
+    
+    def ayears(self, pnums):
+        '{pnum: ayear} for pnums in pat_dates_CURRENT.csv'
+        out   = {}
+        pnums = [int(p) for p in pnums]
+        for i in range(0, len(pnums), 500):
+            chunk = pnums[i:i+500]
+            out.update(self.con.execute('SELECT pnum, ayear FROM patents WHERE pnum IN (%s)' 
+                                        % ','.join('?'*len(chunk)), chunk).fetchall())
+        return out
+    
+    def bag_location(self, pnum):
+        '(bag_path, row_start, row_stop) of a parsed patent, None if no bag'
+        self.flush()
+        return self.con.execute('''
+            SELECT bag_path, row_start, row_stop FROM bags 
+            WHERE pnum = ? AND status = 'parsed' ''', (int(pnum),)).fetchone()
+    
+    def bag_rows(self, min_year, max_year):
+        '{ayear: (# bags, # of those in csv files, # rows in packed shards)}'
+        self.flush()
+        return {r[0]: r[1:] for r in self.con.execute('''
+            SELECT p.ayear, count(*), sum(b.row_start IS NULL), 
+                   coalesce(sum(b.row_stop - b.row_start), 0) FROM bags b
+            JOIN patents p ON p.pnum = b.pnum
+            WHERE p.ayear BETWEEN ? AND ? AND b.status = 'parsed'
+            GROUP BY p.ayear''', (min_year, max_year))}
+    
+    def bag_locations(self, ayear):
+        '[(pnum, bag_path, row_start, row_stop)] of parsed patents applied for in ayear'
+        self.flush()
+        return self.con.execute('''
+            SELECT b.pnum, b.bag_path, b.row_start, b.row_stop FROM bags b
+            JOIN patents p ON p.pnum = b.pnum
+            WHERE p.ayear = ? AND b.status = 'parsed'
+            ORDER BY b.pnum''', (ayear,)).fetchall()
+    
+    # ----- recovery ----- #
+    
+    def rebuild(self, hash_html=False):
+        '''
+        Rebuild the html and bags tables by scanning the disk. Slow (this is 
+        the scan the manifest exists to avoid), but only needed for recovery.
+        hash_html=True also reads every page to fill in sha1 (very slow).
+        '''
+        import os, hashlib
+        from tqdm import tqdm
+        
+        html_rows, bag_rows = [], []
+        
+        for y_path in sorted(os.listdir(self.data_dir)):
+            if y_path[:-4] != 'html_DL_in_':
+                continue
+            year_of_DL = int(y_path[-4:])
+            archive    = HTMLArchive(os.path.join(self.data_dir, y_path))
+            for entry in tqdm(list(os.scandir(archive.year_dir)), 
+                              desc=f'Scanning html DLed in {year_of_DL}'):
+                if entry.is_dir(): # legacy html_<pnum>.txt files
+                    for f in os.scandir(entry.path):
+                        if f.name.startswith('html_') and f.name.endswith('.txt'):
+                            pnum = int(f.name[5:-4])
+                            sha1 = None
+                            if hash_html:
+                                with open(f.path, 'rb') as fh:
+                                    sha1 = hashlib.sha1(fh.read()).hexdigest()
+                            html_rows.append((pnum, year_of_DL, f.stat().st_size, sha1))
+                elif entry.name.endswith('.idx'):
+                    stem = entry.name.split('.')[0]
+                    for pnum, (_, _, length) in archive.index(stem).items():
+                        sha1 = hashlib.sha1(archive.read(pnum)).hexdigest() if hash_html else None
+                        html_rows.append((pnum, year_of_DL, length, sha1))
+        
+        count_dir = os.path.join(self.data_dir,'word_bags','descriptONLY','bags_raw_file_per_pat')
+        if os.path.exists(count_dir):
+            for stem in tqdm(sorted(os.listdir(count_dir)), desc='Scanning raw bags'):
+                for f in os.scandir(os.path.join(count_dir, stem)):
+                    if f.name.startswith('count_'):
+                        bag_rows.append((int(f.name[6:-4]), 'parsed', None,
+                                         f'descriptONLY/bags_raw_file_per_pat/{stem}/{f.name}',
+                                         None, None))
+        
+        # packed shards: the later shard wins if a patent is in several
+        # (e.g. it was dropped and parsed again)
+        import numpy as np
+        store      = RawBagStore(bag_dir=os.path.join(self.data_dir,'word_bags'))
+        packed_dir = os.path.join(store.bag_dir, RawBagStore.packed_dir)
+        shards     = [] # (shard name, bag_path)
+        if os.path.exists(packed_dir):
+            for ayear in os.listdir(packed_dir):
+                for f in os.listdir(os.path.join(packed_dir, ayear)):
+                    if f.endswith('.npy'):
+                        shards.append((f, os.path.join(RawBagStore.packed_dir, ayear, f)))
+        for _, bag_path in tqdm(sorted(shards), desc='Scanning packed raw bags'):
+            pnums, starts, lengths = np.unique(store.shard(bag_path)[0], return_index=True, return_counts=True)
+            bag_rows.extend((int(p), 'parsed', None, bag_path, int(a), int(a+n)) 
+                            for p, a, n in zip(pnums, starts, lengths))
+        store.shards = {}
+        
+        with self.con:
+            self.con.execute('DELETE FROM html')
+            self.con.execute("DELETE FROM bags WHERE status = 'parsed'")
+            self.con.executemany('INSERT OR REPLACE INTO html VALUES (?,?,?,?)', html_rows)
+            self.con.executemany('INSERT OR REPLACE INTO bags VALUES (?,?,?,?,?,?)', bag_rows)
+    
+    def close(self):
+        self.flush()
+        self.con.close()
+
+
+def rebuild_manifest(hash_html=False):
+    '''
+    Recovery command: rebuild data/manifest.sqlite from the html and raw bag
+    files on disk. See Manifest.
+    '''
+    manifest = Manifest(build_if_new=False)
+    manifest.rebuild(hash_html=hash_html)
+    manifest.refresh_pat_dates()
+    manifest.close()
+
+
+def download_gpg_pages(patent_nums,queue_size=1000,batch_size=1000,html_store='archive',
+                       manifest=None,page_sink=None):
     """
     Downloads Google Patent pages for utility patents by iterating over the 
     numbers. Will produce 1 html file (as a txt) per patent, so this requires a lot 
     of time. Google doesn't seem to throttle with the settings below, and it 
     downloads about 10 patents/sec. (~1 million a day) 
     
+    patent_nums can be a list or any iterator. Pnums are streamed through a 
+    bounded queue (queue_size) to a fixed pool of workers, so memory use is 
+    flat even for multi-million pnum backfills. Instead of one global timeout,
+    every batch_size patents must finish within 2 seconds per patent.
+    
+    The number of requests in flight is set by AIMDController: it creeps up 
+    while Google answers quickly with 200s and halves on 429/503/timeouts 
+    (honoring Retry-After). Failed pnums go to RetryLedger 
+    (data/html_retry_ledger.csv) and are retried with exponential backoff, 
+    within this run if the wait is short, else on the next run. 
+    
+    If a Manifest is given, each page written is recorded in it. If a 
+    page_sink (e.g. FusedParser) is given, each page is also handed to it as
+    it arrives. html_store='none' writes nothing (leave it to the sink).
+    
     Saves downloads within data/html_DL_in_<YYYY> where YYYY is the current 
-    year. This is intended to make the code backward compatible and "future
+    year, in compressed HTMLArchive shards (html_store='archive') or as one 
+    html_<pnum>.txt per patent (html_store='files'). This is intended to make 
+    the code backward compatible and "future
     proof" for users that update the data from year to year when the google 
     html structure changes and users want to return to the raw HTML to extract
     more info than the word bags already parsed. (Or to repeat the parsing 
@@ -369,6 +1074,7 @@ def download_gpg_pages(patent_nums):
 
     import os
     import time
+    import hashlib
     import aiohttp
     import asyncio
     import logging
@@ -381,19 +1087,43 @@ def download_gpg_pages(patent_nums):
     nest_asyncio.apply()
     
     class GooglePatentsScraper:
-        def __init__(self, save_dir: str = None, max_concurrent_requests: int = 50,
-                     request_delay: float = 0.1, timeout: int = 30):
+        def __init__(self, save_dir: str = None, max_concurrent_requests: int = 200,
+                     request_delay: float = 0, timeout: int = 30,
+                     queue_size: int = 1000, batch_size: int = 1000,
+                     seconds_per_patent: float = 2, start_concurrency: int = 10,
+                     ledger_path: str = '../data/html_retry_ledger.csv',
+                     max_retry_wait: float = 300, html_store: str = 'archive',
+                     manifest: Manifest = None, page_sink=None):
             self.save_dir = (save_dir if save_dir 
                             else f'../data/html_DL_in_{datetime.now().year}')
             self.max_concurrent_requests = max_concurrent_requests
             self.request_delay = request_delay
             self.timeout = ClientTimeout(total=timeout)
+            self.queue_size = queue_size
+            self.batch_size = batch_size
+            self.seconds_per_patent = seconds_per_patent
+            self.max_retry_wait = max_retry_wait
+            
+            # concurrency is adapted between 1 and max_concurrent_requests
+            self.controller = AIMDController(start=start_concurrency,
+                                             ceiling=max_concurrent_requests,
+                                             latency_target=timeout/6)
+            self.ledger = RetryLedger(ledger_path)
+            self.html_store = html_store
+            self.archive = HTMLArchive(self.save_dir) if html_store == 'archive' else None
+            self.page_sink = page_sink
+            self.manifest = manifest
+            self.year_of_DL = datetime.now().year
+            self.in_flight = 0
+            self.slot_cond = None
             self.headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
                 'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
             }
             self.session = None
             self.rate_limit_queue = None
+            self.attempted_downloads = 0
+            self.finished_downloads = 0
             self.successful_downloads = 0
             self.failed_downloads = 0
             
@@ -428,36 +1158,82 @@ def download_gpg_pages(patent_nums):
                     headers=self.headers,
                     timeout=self.timeout
                 )
-                self.rate_limit_queue = asyncio.Queue()
+                # maxsize=1: idle time can't bank a burst of tokens
+                self.rate_limit_queue = asyncio.Queue(maxsize=1) if self.request_delay else None
+                self.slot_cond = asyncio.Condition()
                 self.logger.info("Session initialized")
     
+        async def acquire_slot(self):
+            'Wait until the controller allows another request in flight'
+            async with self.slot_cond:
+                await self.slot_cond.wait_for(lambda: self.in_flight < self.controller.limit)
+                self.in_flight += 1
+            pause = self.controller.pause_until - time.monotonic()
+            if pause > 0: # honor Retry-After
+                await asyncio.sleep(pause)
+    
+        async def release_slot(self):
+            async with self.slot_cond:
+                self.in_flight -= 1
+                self.slot_cond.notify_all()
+    
         async def download_patent(self, patent_num: int):
             if self.rate_limit_queue:
                 await self.rate_limit_queue.get()
             
             html_file_path = Path(f'{self.save_dir}/{str(patent_num).zfill(8)[:4]}/html_{patent_num}.txt')
-            Path(self.save_dir).mkdir(parents=True, exist_ok=True)
-            Path(f"{self.save_dir}/{str(patent_num).zfill(8)[:4]}").mkdir(exist_ok=True)
             
-            if html_file_path.exists():
+            if html_file_path.exists() or (self.archive and self.archive.has(patent_num)):
                 self.logger.info(f"Already have patent {patent_num}")
+                self.ledger.record_success(patent_num)
+                if self.manifest: # self heal a manifest that missed this file
+                    self.manifest.record_html(patent_num, self.year_of_DL)
                 return
     
             url = f'https://patents.google.com/patent/US{patent_num}'
             
+            await self.acquire_slot()
+            start = time.monotonic()
+            content = None
             try:
-                async with self.session.get(url) as response:
+                # Add timeout to individual downloads (after we got a slot, 
+                # so time spent waiting out a Retry-After doesn't count)
+                async with asyncio.timeout(30), self.session.get(url) as response:
                     if response.status == 200:
                         content = await response.read()
-                        html_file_path.write_bytes(content)
+                        nbytes = None
+                        if self.archive:
+                            nbytes = self.archive.write(patent_num, content)
+                        elif self.html_store == 'files':
+                            html_file_path.parent.mkdir(parents=True, exist_ok=True)
+                            nbytes = html_file_path.write_bytes(content)
+                        if self.manifest and nbytes is not None:
+                            self.manifest.record_html(patent_num, self.year_of_DL, nbytes,
+                                                      hashlib.sha1(content).hexdigest())
                         self.successful_downloads += 1
+                        self.controller.on_success(time.monotonic() - start)
+                        self.ledger.record_success(patent_num)
                         #self.logger.info(f"Successfully downloaded patent {patent_num}")
                     else:
                         self.logger.warning(f"Failed to download patent {patent_num}: Status {response.status}")
                         self.failed_downloads += 1
+                        if response.status in (429, 503): # slow down!
+                            self.controller.on_congestion(
+                                AIMDController.parse_retry_after(response.headers.get('Retry-After')))
+                        self.ledger.record_failure(patent_num, response.status)
             except Exception as e:
                 self.logger.error(f"Error downloading patent {patent_num}: {str(e)}")
                 self.failed_downloads += 1
+                if isinstance(e, asyncio.TimeoutError):
+                    self.controller.on_congestion()
+                self.ledger.record_failure(patent_num, type(e).__name__)
+            finally:
+                await self.release_slot()
+            
+            # hand the page to the parser (outside the timeout: when the 
+            # parsers fall behind, this blocks and slows the downloads)
+            if content is not None and self.page_sink:
+                await self.page_sink.put(patent_num, content)
     
         async def rate_limiter(self):
             while True:
@@ -466,37 +1242,93 @@ def download_gpg_pages(patent_nums):
                     await self.rate_limit_queue.put(1)
     
         async def download_patents_async(self, patent_nums):
-            self.logger.info(f"Starting async download of {len(patent_nums)} patents")
+            self.logger.info("Starting streaming async download")
             try:
                 await self.init_session()
+                if self.page_sink:
+                    await self.page_sink.start()
                 
-                limiter_task = asyncio.create_task(self.rate_limiter())
-                semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+                loop = asyncio.get_running_loop()
+                if self.request_delay: # optional floor on request spacing
+                    asyncio.create_task(self.rate_limiter())
                 
-                async def bounded_download(num):
-                    try:
-                        async with semaphore:
-                            # Add timeout to individual downloads
-                            async with asyncio.timeout(30):  # 30 second timeout per patent
-                                await self.download_patent(num)
-                    except asyncio.TimeoutError:
-                        self.logger.error(f"Timeout downloading patent {num}")
-                        self.failed_downloads += 1
-                    except Exception as e:
-                        self.logger.error(f"Error in bounded_download for patent {num}: {str(e)}")
-                        self.failed_downloads += 1
+                # a fixed pool of workers pulls pnums from a bounded queue. the 
+                # producer blocks when the queue is full, so memory stays flat  
+                # no matter how long patent_nums is (it can be any iterator)
                 
-                # Create all tasks
-                tasks = [asyncio.create_task(bounded_download(num)) for num in patent_nums]
-                tasks.append(limiter_task)
+                queue = asyncio.Queue(maxsize=self.queue_size)
                 
-                # Wait for all tasks with a global timeout
-                try:
-                    async with asyncio.timeout(len(patent_nums) * 2):  # 2 seconds per patent as global timeout
-                        await asyncio.gather(*tasks)
-                except asyncio.TimeoutError:
-                    self.logger.error("Global timeout reached")
-                    raise
+                async def producer():
+                    for num in patent_nums:
+                        if not self.ledger.ready(num): # still backing off
+                            continue
+                        self.ledger.in_queue.add(num) # so due() doesn't queue it again
+                        await queue.put(num)
+                        self.attempted_downloads += 1
+                    
+                    # then retry this run's failures whose backoff expires 
+                    # within max_retry_wait seconds (the rest, and failures 
+                    # from other runs, e.g. other years, wait in the ledger 
+                    # for the next run that asks for them)
+                    while True:
+                        due = self.ledger.due()
+                        for num in due:
+                            self.ledger.in_queue.add(num)
+                            await queue.put(num)
+                            self.attempted_downloads += 1
+                        if not due:
+                            if (self.finished_downloads >= self.attempted_downloads
+                                and not self.ledger.due(self.max_retry_wait)):
+                                break
+                            await asyncio.sleep(1)
+                    for _ in range(self.max_concurrent_requests):
+                        await queue.put(None) # one stop signal per worker
+                
+                async def worker():
+                    while True:
+                        num = await queue.get()
+                        if num is None:
+                            return
+                        try:
+                            await self.download_patent(num)
+                        except Exception as e:
+                            self.logger.error(f"Error in worker for patent {num}: {str(e)}")
+                            self.failed_downloads += 1
+                            self.ledger.record_failure(num, type(e).__name__)
+                        finally:
+                            self.finished_downloads += 1
+                
+                async def progress_watchdog():
+                    # per-batch progress deadline: every batch_size pnums must 
+                    # finish within batch_size * seconds_per_patent seconds, 
+                    # otherwise we assume we're stuck (or blocked) and bail 
+                    while True:
+                        target   = self.finished_downloads + self.batch_size
+                        deadline = loop.time() + self.batch_size * self.seconds_per_patent
+                        while self.finished_downloads < target:
+                            if loop.time() > deadline:
+                                raise asyncio.TimeoutError(f"no batch progress by patent #{self.finished_downloads}")
+                            await asyncio.sleep(1)
+                        self.logger.info(f"Batch done, {self.finished_downloads} patents finished, "
+                                         f"concurrency {self.controller.limit}, "
+                                         f"{len(self.ledger)} pnums in retry ledger")
+                        self.ledger.save()
+                        if self.manifest:
+                            self.manifest.flush()
+                
+                workers  = asyncio.gather(producer(),
+                                          *[worker() for _ in range(self.max_concurrent_requests)])
+                watchdog = asyncio.create_task(progress_watchdog())
+                
+                # run until the workers drain the queue, or the watchdog trips
+                done, _ = await asyncio.wait([workers, watchdog], 
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if self.page_sink: # finish parsing what we have
+                    await self.page_sink.close()
+                if watchdog in done:
+                    self.logger.error(f"Batch progress deadline reached: {watchdog.exception()}")
+                    raise watchdog.exception()
+                workers.result() # surface any unexpected error
                 
             except Exception as e:
                 self.logger.error(f"Error in download_patents_async: {str(e)}")
@@ -515,18 +1347,14 @@ def download_gpg_pages(patent_nums):
     
         def download(self, patent_nums):
             start_time = time.time()
-            self.logger.info(f"Starting download batch of {len(patent_nums)} patents")
+            self.logger.info("Starting download")
             
             loop = asyncio.get_event_loop()
             
             try:
-                # Add a timeout to the entire operation
-                loop.run_until_complete(
-                    asyncio.wait_for(
-                        self.download_patents_async(patent_nums),
-                        timeout=len(patent_nums) * 2  # 2 seconds per patent as overall timeout
-                    )
-                )
+                # no global timeout here: the watchdog in download_patents_async
+                # enforces per-batch progress deadlines instead
+                loop.run_until_complete(self.download_patents_async(patent_nums))
             except (KeyboardInterrupt, asyncio.TimeoutError) as e:
                 self.logger.warning(f"Operation interrupted: {type(e).__name__}")
                 # Cancel all pending tasks
@@ -541,12 +1369,17 @@ def download_gpg_pages(patent_nums):
             except Exception as e:
                 self.logger.error(f"Unexpected error: {str(e)}")
             finally:
+                self.ledger.save()
+                if self.manifest:
+                    self.manifest.flush()
                 elapsed_time = time.time() - start_time
                 summary = f"""
     Download Summary:
-    - Total patents attempted: {len(patent_nums)}
+    - Total download attempts: {self.attempted_downloads}
     - Successful downloads: {self.successful_downloads}
     - Failed downloads: {self.failed_downloads}
+    - Pnums in retry ledger: {len(self.ledger)}
+    - Final concurrency: {self.controller.limit}
     - Elapsed time: {elapsed_time:.2f} seconds
     - Average speed: {self.successful_downloads / max(elapsed_time, 0.001):.2f} patents/second
     """
@@ -556,8 +1389,13 @@ def download_gpg_pages(patent_nums):
    # initialize the class
    
     scraper = GooglePatentsScraper(
-        max_concurrent_requests=50,  # Adjust based on your needs
-        request_delay=0.1  # 100ms between requests
+        max_concurrent_requests=200,  # ceiling, AIMD finds the actual level
+        request_delay=0,  # no fixed spacing, AIMD + Retry-After handle this
+        queue_size=queue_size,
+        batch_size=batch_size,
+        html_store=html_store,
+        manifest=manifest,
+        page_sink=page_sink
     )
     
     # patent_nums = pnums_to_DL[200000:210000]
@@ -566,15 +1404,20 @@ def download_gpg_pages(patent_nums):
     # scraper.download(patent_nums)
 
 
-def download_patent_HTML(min_year=2019,max_year=2019):
+def download_patent_HTML(min_year=2019,max_year=2019,html_store='archive'):
     '''
     For all patents in the "pat_dates_CURRENT.csv" with application years in 
     [min_year, max_year], download the google patent page's html if the patent
-    isn't in an HTML folder.    
+    isn't in an HTML folder (as a file or in an HTMLArchive shard).
+    
+    What we already have comes from the Manifest (data/manifest.sqlite), not
+    a scan of the html folders. If you moved/deleted html by hand, run 
+    rebuild_manifest() first.
+    
+    html_store is passed to download_gpg_pages ('archive' or 'files').
     '''
     
-    import os, logging, subprocess
-    import pandas as pd 
+    import os, logging
     
     # ======================================================================= #
     # %%   set up     
@@ -595,95 +1438,35 @@ def download_patent_HTML(min_year=2019,max_year=2019):
                         filename=log_fname,
                         format='%(asctime)s - %(message)s')
   
-    # df of all patents/appyears applied for in this time period
-    # this is a key input, this is the set of patents we will try to parse 
+    # all patents applied for in this time period that we don't have html 
+    # for, in any html_DL_in_<YYYY> folder (one indexed query)
     
     print('Figuring out what to DL')
     
-    pnum_years_df = pd.read_csv('../data/patent_level_info/pat_dates_CURRENT.csv')\
-                   .query("ayear <= @max_year & ayear >= @min_year")    
-    
-    # detect years we've DLed files (the parser we use depends on the 
-    # formatting of GPG at the time a given page is downloaded)
-    
-    yS_of_DL = [int(y_path[-4:]) 
-                for y_path in os.listdir('../data/')
-                if y_path[:-4] == 'html_DL_in_' ] 
-    
-    # # Function to check if the file exists
-    # def file_exists(pnum, year):
-    #     'year is a year we might have downloaded the patent'
-    #     file_path = f'../data/html_DL_in_{year}/{str(pnum).zfill(8)[:4]}/html_{pnum}.txt'
-    #     return os.path.exists(file_path)
-    
-    # # List to store pnum with no corresponding files
-    # pnums_to_DL = []
-    
-    # # Loop through each row in the DataFrame
-    # for pnum in pnum_years_df['pnum'].to_list():
-    
-    #     # Check if the file is found for any of the possible years
-    #     found_file = any(file_exists(pnum, year) for year in yS_of_DL)
-        
-    #     # If the file is not found for any of the possible years, add pnum to the list
-    #     if not found_file:
-    #         pnums_to_DL.append(pnum)
-        
-    # in 2025, I updated to this:
-    def get_existing_patents(year, base_dir='../data'):
-        """Get patents using fast system commands for either Windows or Unix"""
-        year_dir = f'{base_dir}/html_DL_in_{year}'
-        
-        # Run dir command to get all html_ files recursively
-        # /s is recursive, /b gives bare format (just paths)
-
-        # Choose command based on OS
-        if os.name == 'nt':  # Windows
-            cmd = f'dir /s /b "{year_dir}\\html_*.txt"'
-        else:  # Unix/Mac
-            cmd = f"find '{year_dir}' -name 'html_*.txt'"
-        
-        try:
-            # Run command and get output
-            result = subprocess.run(cmd, capture_output=True, text=True, shell=True)
-            file_list = result.stdout.splitlines()
-            
-            # Extract patent numbers from filenames
-            patents = set()
-            for filepath in file_list:
-                if filepath:  # Skip empty lines
-                    fname = os.path.basename(filepath)
-                    if fname.startswith('html_') and fname.endswith('.txt'):
-                        pnum = int(fname[5:-4])  # Extract number from 'html_12345.txt'
-                        patents.add(pnum)
-            
-            return patents
-        except subprocess.CalledProcessError as e:
-            print(f"Error running dir command: {e}")
-            return set()
-    
-    # now find all the patents we have already
-    existing_patents = set()
-    for year in yS_of_DL:
-        print(f'Finding existing patent html DLed in {year}')
-        year_patents = get_existing_patents(year)
-        existing_patents.update(year_patents)
-    
-    # Find missing patents using set difference
-    needed_patents = set(pnum_years_df['pnum'])
-    pnums_to_DL = list(needed_patents - existing_patents)
+    manifest = Manifest()
+    pnums_to_DL = manifest.to_download(min_year,max_year)
     
     print('Pnums to DL:',len(pnums_to_DL))
     logging.info("DLing HTML for:  %i-%i" % (min_year,max_year))
     logging.info("Pnums to DL:     %i" % (len(pnums_to_DL)))
    
-    download_gpg_pages(pnums_to_DL)
+    download_gpg_pages(pnums_to_DL,html_store=html_store,manifest=manifest)
     
-def parse_bags(min_year=2019,max_year=2019,force_clean=False):
+    manifest.close()
+    
+def parse_bags(min_year=2019,max_year=2019,force_clean=False,n_workers=1,batch_size=5000):
     '''
     For all patents in the "pat_dates_CURRENT.csv" with application years in 
     [min_year, max_year], parse the patents.
     
+    n_workers > 1 parses in that many processes (see parse_bags_parallel), 
+    with exactly the same word_index ids and bags as the serial parse.
+    
+    Which patents are DLed but not parsed comes from the Manifest 
+    (data/manifest.sqlite), and each parse is recorded there.
+    
+    Bags, new words and failures are committed together every batch_size 
+    patents (see ParseBatch), so it is safe to kill this at any time.
     '''
     
     import os, csv, logging, time, lxml, cchardet, re
@@ -715,118 +1498,35 @@ def parse_bags(min_year=2019,max_year=2019,force_clean=False):
                         filename=log_fname,
                         format='%(asctime)s - %(message)s')
 
-    # detect years we've DLed files (the parser we use depends on the 
-    # formatting of GPG at the time a given page is downloaded)
-    
-    yS_of_DL = [int(y_path[-4:]) 
-                for y_path in os.listdir('../data/')
-                if y_path[:-4] == 'html_DL_in_' ] 
-  
-    # df of all patents/appyears applied for in this time period
-    # this is a key input, this is the set of patents we will try to parse 
+    # the patents applied for in this time period (from pat_dates_CURRENT.csv, 
+    # mirrored in the manifest) are the set of patents we will try to parse 
     
     print('Figuring out what to DL, and what to parse')
     
-    pnum_years_df = pd.read_csv('../data/patent_level_info/pat_dates_CURRENT.csv')\
-                    .query("ayear <= @max_year & ayear >= @min_year")    
-     
     # we don't need to parse all those! some might already be done!
-    # so get the subset of patents without bags yet
-    # using set types here is WAY faster than the alternatives :)
-    
-    folder_num_stems = {str(pnum).zfill(8)[:4] for pnum in 
-                        pnum_years_df.pnum.tolist()} # folders w our pats   
-    existing_pnums = {int(p[6:-4]) 
-                      for stem in folder_num_stems 
-                      if os.path.exists(count_dir +'/'+ stem +'/')
-                      for p in os.listdir(count_dir +'/'+ stem +'/')  }    
-    pnums_without_bags = list(set(pnum_years_df.pnum.tolist()) 
-                        - existing_pnums) # pats to bag but haven't already
-    pnums_without_bags = pd.DataFrame(pnums_without_bags,
-                                      columns=['pnum'])\
-                          .merge(pnum_years_df,on='pnum')  # bring in the year info
-    
-    del existing_pnums
-
-    # of this subset, some have not yet been DLed  
-    # and the rest are DLed but need to be parsed 
-    # find out which is true for all the bagless pnums
-    
-    paths_to_HTMLs = [] # DLed but not yet parsed, elements=[pnum,year_of_DL]  
-    pnum_to_DL = []     # not yet been DLed
-    
-    # we have to check the folder_num_stems across all yS_of_DL  
-    existing_htmls = {int(p[5:-4]):y_of_DL
-                      for stem in folder_num_stems 
-                      for y_of_DL in yS_of_DL  
-                      if os.path.exists('../data/html_DL_in_'+str(y_of_DL)+'/'+stem+'/')
-                      for p in os.listdir('../data/html_DL_in_'+str(y_of_DL)+'/'+stem+'/')  }   
-    
-    for pnum in tqdm(pnums_without_bags.pnum.tolist(),desc='Finding pnum to DL:')  :
-        if pnum in existing_htmls.keys():
-            paths_to_HTMLs.append([pnum,existing_htmls[pnum]])
-        else:
-            pnum_to_DL.append(pnum)
-        
-    # attach the app year to those two structures, so the loop below can find
-    # the patents it needs for a given app year
+    # the manifest knows which have bags, and which of the rest are DLed  
+    # (and in which year, since the parser we use depends on the formatting
+    # of GPG at the time a given page is downloaded) 
     
-    pnums_to_parse = pd.DataFrame(paths_to_HTMLs,columns=['pnum','year_of_DL']).merge(pnums_without_bags,on='pnum')
-    pnums_to_DL = pnums_without_bags.query('pnum in @pnum_to_DL')   
-    del pnum_to_DL, paths_to_HTMLs
+    manifest = Manifest()
+    
+    pnums_to_parse = pd.DataFrame(manifest.to_parse(min_year,max_year),
+                                  columns=['pnum','year_of_DL','ayear'])
+    pnums_to_DL = manifest.to_download(min_year,max_year)
                
     # ======================================================================= #
-    # %%=========== Load or Build word_index.csv ============================ #
+    # %%=========== Load or Build word_index.csv and failures.csv =========== #
     # ======================================================================= #
     
     print("Loading word index")
     
-    global word_index, failure_dict # passing this obj between parse_HTML() and clean_bags()    
-    
-    # will be dictionary, allows for easily adding new words with incremented index
-        
-    if os.path.exists(word_index_fname): 
-        
-        # open it    
-        with open(word_index_fname, 'r') as f_csv:
-            csv_reader = csv.reader(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
-            oldwordindex = [row for row in csv_reader]
-            del csv_reader
-        
-        # set up a dictionary where new words get an incremented index
-        # key step! what should the index value of next new word be?
-        # -> next new word's index is large enough that it doesn't exist yet
-        restartindexat = 1 + max([int(row[1]) for row in oldwordindex])
-        word_index = defaultdict(lambda x=count(restartindexat): next(x))  # py3.7 change
-        # py 2.7: count(restartindexat).next
-    
-        # reload old word index file into this dictionary
-        for row in oldwordindex:
-            word_index[row[0]] = int(row[1])
-        del oldwordindex
+    global word_index, failure_dict, parse_batch # passing this obj between parse_HTML() and clean_bags()    
     
-    else:
-        
-        # start word_index the first time
-        word_index = defaultdict(lambda x=count(1): next(x))  # py3.7 change
-        # py 2.7: word_index = defaultdict(count(1).next)
-        
-    # logging.info("Current length of word index:  %i" % len(word_index))
-        
-    # ======================================================================= #
-    # %%=========== Load or Build failures.csv  ============================= #
-    # ======================================================================= #
+    ParseBatch.recover(manifest) # finish/undo batches from a run that was killed
     
-    # will be dictionary, allows for easily adding new failures
+    word_index   = load_word_index(word_index_fname)
+    failure_dict = load_failures(failure_fname)
     
-    if os.path.exists(failure_fname): 
-        with open(failure_fname, 'r', newline='\n') as f_csv:
-            csv_reader = csv.reader(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC)          
-            failure_dict = {row[0]: str(row[1]) for row in csv_reader}
-            
-    else:
-        failure_dict = {}
-
     print('Pnums to DL:',len(pnums_to_DL))
     logging.info("Pnums to DL:  %i" % (len(pnums_to_DL)))
 
@@ -856,13 +1556,36 @@ def parse_bags(min_year=2019,max_year=2019,force_clean=False):
     
             start = time.time()            
             
-            for idx, row in tqdm(pnums_to_parse.query('ayear == @y').iterrows(),desc='Parsing...'): 
+            rows = pnums_to_parse.query('ayear == @y')[['pnum','year_of_DL']].values.tolist()
+            
+            # parse_HTML() needs to alter global word_index and failures
+            # and it should return a success value when it saves a new bag
+            # (parse_bags_parallel does the same, in n_workers processes)
+            # bags are staged in parse_batch, and committed every batch_size
+            
+            parse_batch = ParseBatch(manifest)
+            
+            if n_workers > 1:
+                results = parse_bags_parallel(rows,n_workers)
+            else:
+                results = ((pnum,year_of_DL,parse_HTML(pnum,year_of_DL)) 
+                           for pnum, year_of_DL in rows)
+            
+            for idx, (pnum, year_of_DL, teeeemp) in enumerate(tqdm(results,total=len(rows),desc='Parsing...')): 
 
-                # parse_HTML() needs to alter global word_index and failures
-                # and it should return a success value when it saves a new bag
-                teeeemp = parse_HTML(row['pnum'],row['year_of_DL'])  
                 pnums_parsed.append(teeeemp)
                 
+                # record the outcome with the batch (0 = no html, 
+                # None = no description found)
+                if teeeemp:
+                    parse_batch.record(pnum,'parsed',year_of_DL)
+                elif teeeemp is None:
+                    parse_batch.record(pnum,'failed',year_of_DL)
+                
+                if len(parse_batch) >= batch_size: # commit bags+vocab+failures
+                    parse_batch.commit()
+                    parse_batch = ParseBatch(manifest)
+                
                 # intermittently, it's time to save and print a bunch of info
                 
                 if idx % 5000 == 0 and idx > 0: # intermittent print
@@ -871,91 +1594,593 @@ def parse_bags(min_year=2019,max_year=2019,force_clean=False):
                     logging.info( "Elapsed minutes    %d" %((time.time()-start)/60+1))  
                     logging.info( "Word index length  %i" % ( len(word_index)) )
             
-                if idx % 35000 == 0 and idx > 0: # lower freq saving
+                if idx % 35000 == 0 and idx > 0: # lower freq info
                     
                     logging.info( " " )
-                    logging.info( "Saving..." )
                     logging.info( "At patent pat      %i"% (pnum) )
                     logging.info( "Elapsed minutes    %d" %((time.time()-start)/60+1))
                     logging.info( "Word index length  %i" % ( len(word_index)) )
                     logging.info( " " )
-                    
-                    with open(word_index_fname,"w",newline='') as f_csv:
-                        out_csv = csv.writer(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
-                        out_csv.writerows(word_index.items())                     
-                        
-                    with open(failure_fname,"wb") as f_csv:
-                        out_csv = csv.writer(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
-                        out_csv.writerows(failure_dict.items())               
                 
             end = time.time()
             logging.info( "Elapsed seconds (rounded up): %d" %(end-start+1) )
             logging.info( "Elapsed minutes (rounded up): %d" %((end-start)/60+1))
             
-            # save word_index at the end of each year
+            # commit the last batch at the end of each year
              
             logging.info( "Saving at the end of year %i. Len Index: %i" % (y,len(word_index)))
-            with open(word_index_fname,"w",newline='') as f_csv:
-                out_csv = csv.writer(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
-                out_csv.writerows(word_index.items())                
-            
-            with open(failure_fname,"w") as f_csv:
-                out_csv = csv.writer(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
-                out_csv.writerows(failure_dict.items())                
+            parse_batch.commit()
+            parse_batch = None
+    
+    # fold the journal into word_index.csv, which clean_bags() etc read
+    word_index.compact()
+    failure_dict.compact()
                            
-    years_to_parse = pd.DataFrame(pnums_parsed,columns=['pnum'])\
-                    .merge(pnum_years_df,on='pnum').ayear.to_list()
+    manifest.close()
+    
+    years_to_parse = PatentMeta().lookup([p for p in pnums_parsed if p]).ayear.dropna().to_list()
 
     print('We parsed',len(pnums_parsed),'patents across',len(set(years_to_parse)),'years')
-    logging.info('We parsed',len(pnums_parsed),'patents across',len(set(years_to_parse)),'years')
+    logging.info('We parsed %i patents across %i years' % (len(pnums_parsed),len(set(years_to_parse))))
    
 
+class WordIndex(dict):
+    """
+    word_index: {word: integer id}, where new words get the next id (like the
+    defaultdict this replaces).
+
+    word_index.csv is a snapshot. New (word, id) pairs are also appended to
+    word_index.journal next to it, and loading replays the journal on top of
+    the snapshot. So a save only writes the new words, not the whole vocab:
+
+        flush()   - new pairs -> journal (OS buffer). save_raw_bag() calls
+                    this BEFORE writing a bag, so if the process dies, every
+                    id in a bag on disk can be found in the journal
+        save()    - flush() and fsync the journal (done in batches)
+        sync()    - just the fsync, for a ParseBatch committing in a writer
+                    thread while the main thread adds words
+        compact() - rewrite word_index.csv with everything, empty the journal
+                    (end of a run, so word_index.csv is complete for others)
+
+    A torn last line in the journal (died mid write) is dropped on load.
+    """
+
+    def __init__(self, fname='../data/word_bags/word_index.csv'):
+        import os, csv
+        super().__init__()
+        self.fname   = fname
+        self.journal = os.path.splitext(fname)[0] + '.journal'
+        self.pending = [] # new (word, id) pairs not in the journal yet
+        self.f_jrnl  = None
+
+        if os.path.exists(fname):
+            with open(fname, 'r') as f_csv:
+                for row in csv.reader(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC):
+                    self[row[0]] = int(row[1])
+
+        if os.path.exists(self.journal):
+            with open(self.journal, 'rb') as f:
+                jrnl = f.read()
+            good = jrnl[:jrnl.rfind(b'\n')+1] # complete lines only
+            if len(good) < len(jrnl):
+                with open(self.journal, 'r+b') as f:
+                    f.truncate(len(good))
+            for row in csv.reader(good.decode().splitlines(), delimiter=',',quoting=csv.QUOTE_NONNUMERIC):
+                self[row[0]] = int(row[1])
+
+        # next new word's index is large enough that it doesn't exist yet
+        self.next_id = 1 + max(self.values(), default=0)
+
+    def __missing__(self, word):
+        self[word] = self.next_id
+        self.pending.append((word, self.next_id))
+        self.next_id += 1
+        return self[word]
+
+    def flush(self):
+        import csv
+        if not self.pending:
+            return
+        if self.f_jrnl is None:
+            self.f_jrnl = open(self.journal, 'a', newline='')
+        csv.writer(self.f_jrnl, delimiter=',',quoting=csv.QUOTE_NONNUMERIC).writerows(self.pending)
+        self.f_jrnl.flush()
+        self.pending = []
+
+    def save(self):
+        self.flush()
+        self.sync()
+
+    def sync(self):
+        'fsync what flush() wrote. Leaves pending alone, so another thread can call it'
+        import os
+        if self.f_jrnl is not None:
+            os.fsync(self.f_jrnl.fileno())
+
+    def compact(self):
+        import os, csv
+        self.save()
+        with open(self.fname + '.tmp', 'w', newline='') as f_csv:
+            csv.writer(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC).writerows(self.items())
+            f_csv.flush()
+            os.fsync(f_csv.fileno())
+        os.replace(self.fname + '.tmp', self.fname)
+        # if we die right here, the journal replays ids the snapshot already has: harmless
+        if self.f_jrnl is not None:
+            self.f_jrnl.close()
+            self.f_jrnl = None
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+
+class FailureLog(dict):
+    """
+    failure_dict: {pnum: sections not found}
+
+    parse_failures.csv is itself append-only: new entries are appended by
+    flush()/save() and later rows win on load. compact() rewrites it without
+    the duplicates (patents that fail again each time they're retried).
+    """
+
+    def __init__(self, fname='../data/word_bags/descriptONLY/parse_failures.csv'):
+        import os, csv
+        super().__init__()
+        self.fname   = fname
+        self.pending = []
+        if os.path.exists(fname):
+            with open(fname, 'r', newline='') as f_csv:
+                lines = f_csv.read().splitlines(keepends=True)
+            if lines and not lines[-1].endswith('\n'):
+                lines = lines[:-1] # torn last line
+            for row in csv.reader(lines, delimiter=',',quoting=csv.QUOTE_NONNUMERIC):
+                super().__setitem__(int(row[0]), str(row[1]))
+
+    def __setitem__(self, pnum, failures):
+        super().__setitem__(pnum, failures)
+        self.pending.append((pnum, failures))
+
+    def flush(self, fsync=False):
+        import os, csv
+        if not self.pending:
+            return
+        with open(self.fname, 'a', newline='') as f_csv:
+            csv.writer(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC).writerows(self.pending)
+            if fsync:
+                f_csv.flush()
+                os.fsync(f_csv.fileno())
+        self.pending = []
+
+    def save(self):
+        self.flush(fsync=True)
+
+    def sync(self):
+        'fsync what flush() wrote (see WordIndex.sync)'
+        import os
+        if os.path.exists(self.fname):
+            with open(self.fname, 'a') as f_csv:
+                os.fsync(f_csv.fileno())
+
+    def compact(self):
+        import os, csv
+        with open(self.fname + '.tmp', 'w', newline='') as f_csv:
+            csv.writer(f_csv, delimiter=',',quoting=csv.QUOTE_NONNUMERIC).writerows(self.items())
+            f_csv.flush()
+            os.fsync(f_csv.fileno())
+        os.replace(self.fname + '.tmp', self.fname)
+        self.pending = []
+
+
+def load_word_index(word_index_fname='../data/word_bags/word_index.csv'):
+    '''
+    Load word_index.csv (and replay its journal) into a WordIndex, where new
+    words get an incremented index.
+    '''
+    return WordIndex(word_index_fname)
+
+
+def load_failures(failure_fname='../data/word_bags/descriptONLY/parse_failures.csv'):
+    'failure_dict = {pnum: sections not found}, see FailureLog'
+    return FailureLog(failure_fname)
+
+
+parse_batch = None # the open ParseBatch, if any (global like word_index)
+
+
+class ParseBatch:
+    """
+    Groups parse work into batches that are committed all-or-nothing: the
+    bags, the new word_index entries and the failure records of a batch are
+    either all kept, or all dropped.
+
+    While a batch is open (set as the global parse_batch), write_raw_bag()
+    hands bags to it instead of writing count_<pnum>.csv files. The batch
+    has a staging dir (descriptONLY/staging/<batch>/) with a "begin" file
+    holding the length of word_index.journal and parse_failures.csv at the
+    start of the batch. commit():
+
+        1. writes the bags as RawBagStore shards, one per ayear, named
+           after the batch
+        2. flushes and fsyncs the journal and failures (WordIndex.sync,
+           FailureLog.sync)
+        3. writes the batch's outcomes and bag locations to "commit" (write
+           .tmp + rename, this is the commit point)
+        4. records them in the manifest and removes the staging dir
+
+    recover() runs at the start of parse_bags() and download_and_parse(),
+    before word_index is loaded. A staging dir with a "commit" file is
+    finished (step 4 again, it's idempotent). One without is rolled back:
+    its shards are deleted and the journal and failures are truncated back
+    to their length in "begin". So a parse can be killed at any time.
+    """
+
+    staging_dir = '../data/word_bags/descriptONLY/staging'
+
+    def __init__(self, manifest):
+        import os, time
+        self.manifest = manifest
+        self.outcomes = [] # (pnum, status, year_of_DL)
+        self.bags     = [] # (pnum, word_index ids, counts)
+        self.name     = '%i_%i' % (time.time_ns(), os.getpid())
+        self.dir      = os.path.join(self.staging_dir, self.name)
+        os.makedirs(self.dir)
+
+        word_index.flush() # anything before this belongs to an earlier batch
+        failure_dict.flush()
+        with open(os.path.join(self.dir,'begin'),'w') as f:
+            for fname in (word_index.journal, failure_dict.fname):
+                f.write('%s,%i\n' % (fname, os.path.getsize(fname) if os.path.exists(fname) else 0))
+
+    def __len__(self):
+        return len(self.outcomes)
+
+    def add(self, pnum, id_counts):
+        'Called by write_raw_bag()'
+        import numpy as np
+        id_counts = np.array(list(id_counts), dtype=np.int32).reshape(-1,2)
+        self.bags.append((pnum, id_counts[:,0], id_counts[:,1]))
+
+    def record(self, pnum, status, year_of_DL):
+        "status is 'parsed' (a bag was added) or 'failed' (no description)"
+        self.outcomes.append((pnum, status, year_of_DL))
+
+    def commit(self):
+        word_index.flush()
+        failure_dict.flush()
+        self.write(self.manifest.ayears([pnum for pnum, _, _ in self.bags]))
+        ParseBatch.finish(self.dir, self.manifest)
+
+    def write(self, ayears):
+        '''
+        Steps 1-3 of commit(), ayears = {pnum: ayear} of the bags. Doesn't 
+        use the manifest or add to word_index/failure_dict, so it can run in
+        a writer thread (FusedParser) while the next batch stages, if the 
+        batch's words and failures were flushed first (opening the next 
+        batch does that). finish() then does step 4.
+        '''
+        import os
+        from collections import defaultdict
+
+        # 1. shards (one per ayear, so clean_bags() reads an ayear's shards)
+        by_ayear = defaultdict(list)
+        for bag in self.bags:
+            by_ayear[ayears.get(bag[0], 0)].append(bag)
+        store     = RawBagStore(self.manifest)
+        locations = {}
+        for ayear, bags in by_ayear.items():
+            bag_path = os.path.join(RawBagStore.packed_dir, str(ayear), self.name + '.npy')
+            for pnum, rows in store.write_shard(bag_path, bags).items():
+                locations[pnum] = (bag_path,) + rows
+
+        # 2. vocab and failures (already flushed, see commit())
+        word_index.sync()
+        failure_dict.sync()
+
+        # 3. commit point
+        with open(os.path.join(self.dir,'commit.tmp'),'w') as f:
+            for pnum, status, year_of_DL in self.outcomes:
+                bag_path, row_start, row_stop = locations.get(pnum, ('', -1, -1))
+                f.write('%i,%s,%i,%s,%i,%i\n' % (pnum, status, year_of_DL, bag_path, row_start, row_stop))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(os.path.join(self.dir,'commit.tmp'), os.path.join(self.dir,'commit'))
+
+    @staticmethod
+    def finish(batch_dir, manifest):
+        'Step 4 of commit(). Safe to rerun.'
+        import os, shutil
+        with open(os.path.join(batch_dir,'commit')) as f:
+            outcomes = [line.split(',') for line in f.read().splitlines()]
+        for pnum, status, year_of_DL, bag_path, row_start, row_stop in outcomes:
+            if status == 'parsed':
+                manifest.record_bag(int(pnum), status, int(year_of_DL),
+                                    bag_path, int(row_start), int(row_stop))
+            else:
+                manifest.record_bag(int(pnum), status, int(year_of_DL))
+        manifest.flush()
+        shutil.rmtree(batch_dir)
+
+    @staticmethod
+    def rollback(batch_dir):
+        import os, shutil, logging, glob
+        with open(os.path.join(batch_dir,'begin')) as f:
+            for line in f.read().splitlines():
+                fname, size = line.rsplit(',',1)
+                if os.path.exists(fname) and os.path.getsize(fname) > int(size):
+                    with open(fname,'r+b') as f_trunc:
+                        f_trunc.truncate(int(size))
+        name = os.path.basename(os.path.normpath(batch_dir))
+        for shard in glob.glob(os.path.join(RawBagStore().bag_dir, RawBagStore.packed_dir, '*', name + '.npy*')):
+            os.remove(shard)
+        shutil.rmtree(batch_dir)
+        logging.info("Rolled back interrupted parse batch %s" % batch_dir)
+
+    @classmethod
+    def recover(cls, manifest):
+        'Finish committed batches and roll back interrupted ones (oldest first)'
+        import os, shutil
+        if not os.path.exists(cls.staging_dir):
+            return
+        for name in sorted(os.listdir(cls.staging_dir)):
+            batch_dir = os.path.join(cls.staging_dir, name)
+            if os.path.exists(os.path.join(batch_dir,'commit')):
+                cls.finish(batch_dir, manifest)
+            elif os.path.exists(os.path.join(batch_dir,'begin')):
+                cls.rollback(batch_dir)
+            else: # died inside __init__, nothing was written yet
+                shutil.rmtree(batch_dir)
+
+
+class RawBagStore:
+    """
+    Raw bags (pnum, word_index, count) packed into shards, instead of one
+    count_<pnum>.csv file per patent.
+
+    A shard is descriptONLY/bags_raw_packed/<ayear>/<name>.npy: an int32
+    array of shape (3, rows) whose rows are the pnum, word_index and count
+    columns (so each column is contiguous), with each patent's rows
+    contiguous and in word_index order. ParseBatch writes one shard per 
+    ayear per batch, and pack_raw_bags() migrates the csv files.
+
+    The manifest's bags table is the index: bag_path plus [row_start,
+    row_stop) for packed bags, just bag_path for csv files. So
+
+        read(pnum)   - one patent: a slice of the memory mapped shard
+        scan(ayear)  - all bags of an ayear in pnum order, in batches of
+                       patents, reading each shard sequentially
+
+    both work for bags in either format.
+    """
+
+    COLUMNS    = ('pnum','word_index','count')
+    packed_dir = 'descriptONLY/bags_raw_packed' # relative to bag_dir
+
+    def __init__(self, manifest=None, bag_dir='../data/word_bags'):
+        self.manifest = manifest
+        self.bag_dir  = bag_dir
+        self.shards   = {} # bag_path: memmap
+
+    def shard(self, bag_path):
+        import os
+        import numpy as np
+        if bag_path not in self.shards:
+            self.shards[bag_path] = np.load(os.path.join(self.bag_dir, bag_path), mmap_mode='r')
+        return self.shards[bag_path]
+
+    @staticmethod
+    def read_csv(path):
+        'A count_<pnum>.csv file -> (word_index, count) int32 arrays'
+        import numpy as np
+        with open(path) as f:
+            id_counts = np.array(f.read().replace('\n',',').split(',')[:-1], dtype=np.int32).reshape(-1,2)
+        return id_counts[:,0], id_counts[:,1]
+
+    def write_shard(self, bag_path, bags):
+        '''
+        bags = [(pnum, word_index ids, counts), ...] -> a new shard at
+        bag_path (written to .tmp, fsync'd, renamed).
+        Returns {pnum: (row_start, row_stop)}.
+        '''
+        import os
+        import numpy as np
+        lengths = np.array([len(ids) for _, ids, _ in bags], dtype=np.int64)
+        stops   = np.cumsum(lengths)
+        orders  = [np.argsort(ids, kind='stable') for _, ids, _ in bags] # rows by word_index
+        columns = np.empty((3, stops[-1]), dtype=np.int32)
+        columns[0] = np.repeat([pnum for pnum, _, _ in bags], lengths)
+        columns[1] = np.concatenate([ids[order] for (_, ids, _), order in zip(bags, orders)])
+        columns[2] = np.concatenate([counts[order] for (_, _, counts), order in zip(bags, orders)])
+
+        path = os.path.join(self.bag_dir, bag_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, columns)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        return {int(pnum): (int(stop - n), int(stop))
+                for (pnum, _, _), n, stop in zip(bags, lengths, stops)}
+
+    def read(self, pnum):
+        '(word_index, count) int32 arrays for one patent, None if no bag'
+        import os
+        import numpy as np
+        loc = self.manifest.bag_location(pnum)
+        if loc is None:
+            return None
+        bag_path, row_start, row_stop = loc
+        if row_start is None:
+            return self.read_csv(os.path.join(self.bag_dir, bag_path))
+        shard = self.shard(bag_path)
+        return np.array(shard[1, row_start:row_stop]), np.array(shard[2, row_start:row_stop])
+
+    def scan(self, ayear, batch_size=25000, pnums=None):
+        '''
+        Yields (pnums, columns) for the bags of patents applied for in ayear,
+        batch_size patents at a time, in pnum order. columns is an int32
+        array of shape (3, rows): pnum, word_index, count. 
+        
+        pnums: only scan these patents
+        '''
+        import os
+        import numpy as np
+
+        locs = self.manifest.bag_locations(ayear)
+        if pnums is not None:
+            pnums = set(pnums)
+            locs  = [loc for loc in locs if loc[0] in pnums]
+
+        for i in range(0, len(locs), batch_size):
+            batch = locs[i:i+batch_size]
+
+            # runs of consecutive rows in one shard are read as one slice
+            parts, run = [], None
+            for pnum, bag_path, row_start, row_stop in batch:
+                if row_start is None:
+                    ids, counts = self.read_csv(os.path.join(self.bag_dir, bag_path))
+                    parts.append(np.vstack([np.full(len(ids), pnum, dtype=np.int32), ids, counts]))
+                    run = None
+                elif run and run[0] == bag_path and run[2] == row_start:
+                    run[2] = row_stop
+                    continue
+                else:
+                    run = [bag_path, row_start, row_stop]
+                    parts.append(run)
+
+            columns = [self.shard(p[0])[:, p[1]:p[2]] if isinstance(p, list) else p for p in parts]
+            yield [loc[0] for loc in batch], (np.concatenate(columns, axis=1) if columns
+                                              else np.empty((3, 0), dtype=np.int32))
+
+        self.shards = {}
+
+
+def pack_raw_bags(patents_per_shard=50000, delete_files=True):
+    '''
+    One-time migration of the count_<pnum>.csv raw bags into RawBagStore
+    shards (one set of shards per ayear), and pointing the manifest at them.
+    The csv files are deleted once the manifest has the new locations.
+    Safe to rerun if interrupted.
+    '''
+    import os, time
+    from tqdm import tqdm
+    from itertools import groupby
+
+    manifest = Manifest()
+    manifest.flush()
+    store    = RawBagStore(manifest)
+    legacy   = manifest.con.execute('''
+        SELECT b.pnum, b.year_of_DL, b.bag_path, coalesce(p.ayear, 0) FROM bags b
+        LEFT JOIN patents p ON p.pnum = b.pnum
+        WHERE b.status = 'parsed' AND b.row_start IS NULL
+        ORDER BY 4, b.pnum''').fetchall()
+
+    for ayear, rows in groupby(legacy, key=lambda row: row[3]):
+        rows = list(rows)
+        for i in tqdm(range(0, len(rows), patents_per_shard), desc=f'Packing raw bags for {ayear}'):
+            chunk    = rows[i:i+patents_per_shard]
+            bags     = [(pnum,) + store.read_csv(os.path.join(store.bag_dir, bag_path))
+                        for pnum, _, bag_path, _ in chunk]
+            bag_path = os.path.join(RawBagStore.packed_dir, str(ayear), '%i_packed.npy' % time.time_ns())
+            locs     = store.write_shard(bag_path, bags)
+            for pnum, year_of_DL, _, _ in chunk:
+                manifest.record_bag(pnum, 'parsed', year_of_DL, bag_path, *locs[pnum])
+            manifest.flush()
+            if delete_files:
+                for _, _, old_path, _ in chunk:
+                    os.remove(os.path.join(store.bag_dir, old_path))
+
+    manifest.close()
+
+
 def parse_HTML(pnum,year_of_DL):
     '''
     Parses one patent's HTML. year_of_DL indicates the location of the file 
     and tells this function which set of parsing rules to use (which is based
     on the HTML structure google used in a given year)
+    
+    Patents that already have a bag aren't passed in: parse_bags() gets its
+    rows from Manifest.to_parse(), which leaves them out (bags table).
     '''
  
-    import lxml, cchardet # speed! leave, these are actually used 
-    from bs4 import BeautifulSoup
     from collections import Counter
-    from bs4 import SoupStrainer
-    import os
-    import pandas as pd
-        
-    # input/output file paths 
-    
-    html_file_path = '../data/html_DL_in_%s/%s/html_%i.txt'\
-        % (year_of_DL, str(pnum).zfill(8)[:4], pnum)
-      
-    pnum_count_path = os.path.join('../data/word_bags/','descriptONLY','bags_raw_file_per_pat',
-                             str(pnum).zfill(8)[:4],'count_'+str(pnum)+'.csv')
-        
-    os.makedirs(os.path.dirname(pnum_count_path), exist_ok=True) # make sure dst folder exists
         
-    # only proceed if input exists and output does not
+    # input file (the html is read through HTMLArchive, which also finds 
+    # legacy html_<pnum>.txt files)
     
-    if not os.path.exists(html_file_path) or os.path.exists(pnum_count_path):
-        return 0 # exits function 
+    archive = HTMLArchive.for_year(year_of_DL)
        
     # ----- Open the html file ----- #
     
-    if year_of_DL > 2019:
-        with open(html_file_path, 'r', encoding="utf8") as html_file:
-            html = html_file.read()       
-    else:     
-        with open(html_file_path, 'r') as html_file:
-            html = html_file.read()
+    html = archive.read(pnum)
+    if html is None:
+        return 0 # exits function 
     
     # ----- Get the patent text ----- #
     
-    # print('have html')
-    successes = 0
-    failures    = ''     
-    abstract_text, claims_text, descrip_text = '','',''
-    
-    if year_of_DL > 2014: # 2020 and 2021 confirmed here. 
+    pat_text, failures = html_to_words(decode_html(html,year_of_DL),year_of_DL)
+           
+    if len(failures) > 0:
+        
+        failure_dict[pnum] = failures # failure_dict is a global var (from clean_bags), this modifies the global
+        
+    # ----- Clean/save the bag of words, update/save the word index ----- #
+
+    if pat_text is not None:        
+        
+        save_raw_bag(pnum,Counter(pat_text))
+            
+        return pnum # so we can track which years to run the corpus cleaning on
+    
+
+def raw_bag_path(pnum):
+    'Where the raw bag (word_index,count csv) for a patent lives'
+    import os
+    return os.path.join('../data/word_bags/','descriptONLY','bags_raw_file_per_pat',
+                        str(pnum).zfill(8)[:4],'count_'+str(pnum)+'.csv')
+
+
+def decode_html(html,year_of_DL):
+    'Raw page bytes -> str, the way the downloaded files have always been read'
+    import locale
+    if year_of_DL > 2019:
+        return html.decode("utf8")
+    else: # same as open(..., 'r') on these older files  
+        return html.decode(locale.getpreferredencoding(False))
+
+
+def html_to_words(html,year_of_DL,engine='lxml'):
+    '''
+    The parsing rules. Returns (words, failures): the words in the patent 
+    text in order (a-zA-Z --> lower, all else is a separator), or None if no
+    section was found, and a string listing the sections that weren't found. 
+    
+    year_of_DL picks the rules, based on the HTML structure google used then.
+    
+    For pages DLed after 2014, engine='lxml' uses extract_description(), a 
+    streaming extractor that gets the same text without building a 
+    BeautifulSoup tree. engine='bs4' is the original code (kept for 
+    benchmark_extractors() and as a fallback). The 2014 layout always uses bs4.
+    '''
+    
+    import lxml, cchardet # speed! leave, these are actually used 
+    from bs4 import BeautifulSoup
+    from bs4 import SoupStrainer
+    
+    # print('have html')
+    successes = 0
+    failures    = ''     
+    abstract_text, claims_text, descrip_text = '','',''
+    
+    if year_of_DL > 2014 and engine == 'lxml':
+        
+        descrip_text = extract_description(html)
+        if descrip_text is None:
+            descrip_text    = ''
+            failures        += ' desc'
+        else:
+            successes = 1
+    
+    elif year_of_DL > 2014: # 2020 and 2021 confirmed here. 
     
         try: # some patents are missing descrip and/or claim and/or abs            
             soup=BeautifulSoup(html,'lxml',parse_only=SoupStrainer('section',itemprop='description')) #parse_only is SPEED!            
@@ -993,53 +2218,540 @@ def parse_HTML(pnum,year_of_DL):
         except:
             descrip_text    = ' '
             failures        += ' desc'
-           
-    if len(failures) > 0:
+    
+    if successes == 0:
+        return None, failures
+    
+    # clean text a-zA-Z --> lower, all else --> deleted as a space
+    
+    pat_text = tokenize(abstract_text + " " + claims_text + " " + descrip_text)
+    
+    return pat_text, failures
+
+
+def extract_description(html,chunk_size=65536):
+    '''
+    Streaming replacement for (post 2014 pages):
         
-        failure_dict[pnum] = failures # failure_dict is a global var (from clean_bags), this modifies the global
+        soup = BeautifulSoup(html,'lxml',parse_only=SoupStrainer('section',itemprop='description'))
+        u' '.join(soup.find('div',{'class':'description'}).findAll(text=True))
+    
+    bs4's lxml builder is itself driven by lxml parser events, so this 
+    listens to the same events with a small state machine instead of 
+    building a tree: find the first <div> with class "description" inside a
+    <section itemprop="description">, collect its text nodes (comments, 
+    scripts and PIs included, as findAll(text=True) does), and stop feeding 
+    the parser once that div closes, skipping the claims, citations, etc.
+    
+    Returns the text (strings joined by ' '), or None if there is no 
+    description div.
+    '''
+    
+    from lxml import etree
+    
+    class DescriptionTarget:
+        def __init__(self):
+            self.section_depth = 0     # > 0 inside <section itemprop="description">
+            self.div_depth     = 0     # > 0 inside the description div
+            self.done          = False
+            self.strings       = []    # text nodes, like bs4's NavigableStrings
+            self.buffer        = []    # pieces of the current text node
         
-    # ----- Clean/save the bag of words, update/save the word index ----- #
-
-    if successes > 0:        
+        def flush(self):
+            if self.buffer:
+                self.strings.append(''.join(self.buffer))
+                self.buffer = []
         
-        # clean text a-zA-Z --> lower, all else --> deleted as a space
+        def start(self, tag, attrib):
+            if self.done:
+                return
+            if self.div_depth:
+                self.flush()
+                self.div_depth += 1
+            elif self.section_depth:
+                self.section_depth += 1
+                if tag == 'div' and 'description' in attrib.get('class', '').split():
+                    self.div_depth = 1
+            elif tag == 'section' and attrib.get('itemprop') == 'description':
+                self.section_depth = 1
         
-        pat_text = ''.join([i.lower() if (ord(i) <= 90 and ord(i)>=65) or (ord(i) >= 97 and ord(i) <= 122 ) 
-                            else ' '  
-                            for i in abstract_text + " " + claims_text + " " + descrip_text
-                            ]).split()                                
-               
-        # update master word index
+        def end(self, tag):
+            if self.done:
+                return
+            if self.div_depth:
+                self.flush()
+                self.div_depth -= 1
+                self.done = self.div_depth == 0
+            elif self.section_depth:
+                self.section_depth -= 1
+        
+        def data(self, data):
+            if self.div_depth and not self.done:
+                self.buffer.append(data)
         
-        [word_index[k] for k in pat_text] # word_index is a global var (from clean_bags), this modifies the global
+        def comment(self, text):
+            if self.div_depth and not self.done:
+                self.flush()
+                self.strings.append(text)
         
-        # replace words in this patent with index number
+        def pi(self, target, data=None):
+            if self.div_depth and not self.done:
+                self.flush()
+                self.strings.append(target + ' ' + (data or ''))
+        
+        def close(self):
+            pass
+    
+    target = DescriptionTarget()
+    parser = etree.HTMLParser(target=target, recover=True, strip_cdata=False)
+    for i in range(0, len(html), chunk_size):
+        parser.feed(html[i:i+chunk_size])
+        if target.done: # don't parse the rest of the page
+            break
+    else:
+        if len(html) > 0:
+            parser.close()
+    
+    if target.div_depth == 0 and not target.done:
+        return None
+    target.flush()
+    return u' '.join(target.strings)
+
+
+def benchmark_extractors(year_of_DL=None,n_pages=1000,engines=('bs4','lxml')):
+    '''
+    Compare the html_to_words() engines on n_pages stored pages DLed in 
+    year_of_DL (default: the latest year): docs/sec, peak RSS (MB), and 
+    whether each engine gets the same words as the first one.
+    
+    Each engine runs in a fresh process so the peak RSS numbers are its own.
+    (Peak RSS uses the resource module, so it's not available on Windows.)
+    '''
+    
+    import os
+    import multiprocessing as mp
+    import pandas as pd
+    
+    if year_of_DL is None:
+        year_of_DL = max(int(y_path[-4:]) for y_path in os.listdir('../data/')
+                         if y_path[:-4] == 'html_DL_in_')
+    
+    manifest = Manifest()
+    pnums = [r[0] for r in manifest.con.execute(
+                'SELECT pnum FROM html WHERE year_of_DL = ? ORDER BY pnum LIMIT ?',
+                (year_of_DL, n_pages))]
+    manifest.close()
+    
+    results = []
+    ctx = mp.get_context('spawn')
+    for engine in engines:
+        with ctx.Pool(1) as pool:
+            results.append(pool.apply(run_extractor_benchmark, (engine, year_of_DL, pnums)))
+    
+    out = pd.DataFrame([r[:3] for r in results], columns=['engine','docs_per_sec','peak_rss_MB'])
+    out['same_words_as_'+engines[0]] = [sum(a == b for a, b in zip(results[0][3], r[3])) / max(len(pnums), 1)
+                                       for r in results]
+    print('Extractor benchmark on',len(pnums),'pages DLed in',year_of_DL)
+    print(out.to_string(index=False))
+    return out
+
+
+def run_extractor_benchmark(engine,year_of_DL,pnums):
+    'One engine\'s run for benchmark_extractors(), in its own process'
+    import time, hashlib
+    
+    # pages are read one at a time (and not timed) so peak RSS reflects the
+    # parser, not a corpus held in memory
+    archive = HTMLArchive.for_year(year_of_DL)
+    elapsed, digests = 0, []
+    for pnum in pnums:
+        html  = decode_html(archive.read(pnum),year_of_DL)
+        start = time.time()
+        words = html_to_words(html,year_of_DL,engine=engine)[0]
+        elapsed += time.time() - start
+        digests.append(None if words is None else hashlib.sha1(' '.join(words).encode()).hexdigest())
+    
+    try:
+        import resource, sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_MB = peak / 2**20 if sys.platform == 'darwin' else peak / 2**10 # bytes on mac, KB on linux
+    except ImportError:
+        peak_MB = None
+    
+    return engine, len(pnums) / max(elapsed, 1e-9), peak_MB, digests
+
+
+# byte -> byte table for tokenize(): A-Z -> a-z, a-z kept, all else -> space
+TOKEN_TABLE = bytes(c + 32 if 65 <= c <= 90 else c if 97 <= c <= 122 else 32 
+                    for c in range(256))
+
+
+def tokenize(text):
+    '''
+    Split text into words: ASCII a-z after lowercasing, everything else 
+    (digits, punctuation, whitespace, ANY non-ASCII char) is a separator.
+    
+    Same output as the per-character ord() loop parse_HTML used to run 
+    (tests/test_tokenize.py), but all the work happens in C: non-ASCII 
+    chars become '?' on encoding, then one bytes.translate maps letters to 
+    lowercase and everything else to a space. Much faster on long 
+    descriptions. (Note: lowercasing BEFORE filtering would be wrong, e.g.
+    '\u0130'.lower() and the Kelvin sign lower to ASCII letters.)
+    '''
+    return text.encode('ascii','replace').translate(TOKEN_TABLE).decode('ascii').split()
+
+
+def tokenize_batch(texts):
+    'tokenize() for many documents, returns a list of word lists'
+    return [tokenize(text) for text in texts]
+
+
+def count_words(words,vocab):
+    '''
+    Count a document's words with a vocabulary {word: id} that is extended in
+    place (new words get the next id). Returns int32 arrays (ids, counts), 
+    ids in order of first appearance in the document.
+    '''
+    import numpy as np
+    from collections import Counter
+    counts = Counter([vocab.setdefault(w, len(vocab)) for w in words])
+    return (np.fromiter(counts.keys(),   np.int32, len(counts)),
+            np.fromiter(counts.values(), np.int32, len(counts)))
+
+
+def count_words_batch(texts,vocab=None):
+    '''
+    Tokenize and count many documents at once with one shared vocabulary.
+    
+    Returns (vocab, bags): vocab is {word: id} in order of first appearance
+    across the batch (pass it back in to continue it), bags has the 
+    (ids, counts) int32 arrays for each text.
+    '''
+    vocab = {} if vocab is None else vocab
+    return vocab, [count_words(tokenize(text),vocab) for text in texts]
 
-        pat_text  = [word_index.get(item,item) for item in pat_text] #2
-        text_counter = Counter(pat_text) #3
+
+def save_raw_bag(pnum,word_counts):
+    '''
+    Convert {word: count} to word_index ids (adding new words to the global
+    word_index, in order of first appearance) and save the patent's raw bag.
+    '''
+    # update master word index, replace words in this patent with index number
+    
+    text_counter = {word_index[k]: v for k, v in word_counts.items()} # word_index is a global var (from clean_bags), this modifies the global
+    
+    # new ids hit the journal before any bag uses them
+    word_index.flush()
+    failure_dict.flush()
+    
+    # save this patent to file
+    write_raw_bag(pnum,text_counter.items())
+    
+
+def write_raw_bag(pnum,id_counts):
+    '''
+    Save (word_index, count) pairs as the patent's raw bag csv. (Plain 
+    writes, same file as the pandas to_csv this replaced, much less overhead.)
+    If a ParseBatch is open, the bag goes to it instead (and from there into 
+    a RawBagStore shard when the batch commits).
+    '''
+    import os
+    if parse_batch is not None:
+        parse_batch.add(pnum,id_counts)
+        return
+    os.makedirs(os.path.dirname(raw_bag_path(pnum)), exist_ok=True) # make sure dst folder exists
+    with open(raw_bag_path(pnum),'w') as f:
+        f.write(''.join(['%i,%i\n' % (i, c) for i, c in id_counts]))
+    
+
+def parse_chunk(rows):
+    '''
+    Worker side of parse_bags_parallel(). rows = [[pnum, year_of_DL], ...]
+    
+    Tokenizes and counts with a LOCAL vocabulary, since workers can't share
+    the global word_index. Returns (vocab, parsed) where vocab lists the 
+    chunk's words in order of first appearance (local id = position) and 
+    parsed has (pnum, year_of_DL, outcome, failures, local_ids, counts) per 
+    row. outcome is what parse_HTML() would return.
+    '''
+    vocab  = {} # word: local id
+    parsed = []
+    
+    for pnum, year_of_DL in rows:
         
-        # save this patent to file
-        pd.DataFrame(text_counter.items(),
-                     columns=['word_index','count'])\
-            .to_csv(pnum_count_path,index=False,header=False)
+        # only proceed if input exists (rows have no bag, see parse_HTML)
+        html = HTMLArchive.for_year(year_of_DL).read(pnum)
+        if html is None:
+            parsed.append((pnum, year_of_DL, 0, '', None, None))
+            continue
+        
+        words, failures = html_to_words(decode_html(html,year_of_DL),year_of_DL)
+        if words is None:
+            parsed.append((pnum, year_of_DL, None, failures, None, None))
+            continue
+        
+        parsed.append((pnum, year_of_DL, pnum, failures) + count_words(words,vocab))
+    
+    return list(vocab), parsed
+
+
+def parse_bags_parallel(rows,n_workers,chunk_size=250):
+    '''
+    Parallel engine for parse_bags(). rows = [[pnum, year_of_DL], ...]
+    
+    Workers (parse_chunk) do the expensive part (read, extract, tokenize, 
+    count) on chunks of rows with local vocabularies. This process merges 
+    the chunks IN ORDER: new words get the next global word_index id in the
+    order the chunk first saw them, local ids are remapped, and the bag is
+    saved. That is exactly the order a serial parse assigns ids, so the 
+    word_index and bags are identical to parse_HTML() one patent at a time.
+    
+    Yields (pnum, year_of_DL, outcome) per row, in order, like parse_HTML().
+    '''
+    import numpy as np
+    import multiprocessing as mp
+    
+    chunks = (rows[i:i+chunk_size] for i in range(0, len(rows), chunk_size))
+    
+    with mp.Pool(n_workers) as pool:
+        for vocab, parsed in pool.imap(parse_chunk, chunks): # imap keeps order
             
-        return pnum # so we can track which years to run the corpus cleaning on
+            remap = np.array([word_index[w] for w in vocab], dtype=np.int64) # global word_index is updated here
+            word_index.flush() # journal the new ids before any bag uses them
+            
+            for pnum, year_of_DL, outcome, failures, local_ids, counts in parsed:
+                if len(failures) > 0:
+                    failure_dict[pnum] = failures
+                if outcome:
+                    write_raw_bag(pnum,zip(remap[local_ids],counts))
+                yield pnum, year_of_DL, outcome
+    
+    
+class FusedParser:
+    """
+    Page sink for download_gpg_pages() that parses pages as they come off 
+    the aiohttp session, instead of writing them to disk for parse_bags() to 
+    reread. Network latency overlaps with the CPU-bound parsing.
+    
+    Pages go through a bounded queue (queue_size) to a process pool that 
+    runs parse_page(). When the parsers fall behind, the queue fills and the 
+    downloaders wait (backpressure). The main process turns words into 
+    word_index ids and saves the raw bags, exactly as parse_HTML() would.
+    
+    If keep_html, the raw pages are also appended to the HTMLArchive in a 
+    background thread, otherwise they are never written.
+    
+    Bags are committed in ParseBatches of checkpoint_every patents (needs a
+    manifest). A batch's shards and fsyncs happen in the writer thread while
+    the next batch stages, one commit at a time.
+    """
+    
+    def __init__(self, year_of_DL, n_workers=None, queue_size=256, keep_html=True,
+                 manifest=None, checkpoint_every=5000):
+        import os
+        self.year_of_DL       = year_of_DL
+        self.n_workers        = n_workers or os.cpu_count()
+        self.queue_size       = queue_size
+        self.keep_html        = keep_html
+        self.manifest         = manifest
+        self.checkpoint_every = checkpoint_every
+        self.archive          = HTMLArchive.for_year(year_of_DL) if keep_html else None
+        self.parsed           = [] # pnums with new bags
+    
+    async def start(self):
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        self.queue      = asyncio.Queue(maxsize=self.queue_size)
+        self.pool       = ProcessPoolExecutor(self.n_workers)
+        self.writer     = ThreadPoolExecutor(1) # one thread, so shard appends don't interleave
+        self.unwritten  = asyncio.Semaphore(self.queue_size) # bounds pages waiting on the writer
+        self.archiving  = set()
+        self.consumer   = asyncio.create_task(self.consume())
+        self.committing = None # task of the batch commit in progress
+        global parse_batch
+        parse_batch = ParseBatch(self.manifest)
+    
+    async def put(self, pnum, html):
+        import asyncio
+        if self.keep_html:
+            await self.unwritten.acquire()
+            task = asyncio.create_task(self.archive_page(pnum, html))
+            self.archiving.add(task)
+            task.add_done_callback(self.archiving.discard)
+        await self.queue.put((pnum, html)) # blocks when parsers are behind
+    
+    async def archive_page(self, pnum, html):
+        import asyncio, hashlib
+        try:
+            nbytes = await asyncio.get_running_loop().run_in_executor(
+                        self.writer, self.archive.write, pnum, html)
+            if self.manifest:
+                self.manifest.record_html(pnum, self.year_of_DL, nbytes,
+                                          hashlib.sha1(html).hexdigest())
+        finally:
+            self.unwritten.release()
+    
+    async def consume(self):
+        import asyncio, logging
+        loop    = asyncio.get_running_loop()
+        pending = {} # future: pnum
+        
+        def collect(done):
+            for fut in done:
+                pnum = pending.pop(fut)
+                try:
+                    self.store(*fut.result())
+                except Exception as e:
+                    logging.info("Fused parse of %i failed: %s" % (pnum, e))
+                    parse_batch.record(pnum, 'failed', self.year_of_DL)
+        
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                break
+            pending[loop.run_in_executor(self.pool, parse_page, *item, self.year_of_DL)] = item[0]
+            if len(pending) >= 2 * self.n_workers: # keep the pool busy, no more
+                done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+                if len(parse_batch) >= self.checkpoint_every:
+                    await self.checkpoint()
+        if pending:
+            done, _ = await asyncio.wait(list(pending))
+            collect(done)
+    
+    def store(self, pnum, word_counts, failures):
+        if len(failures) > 0:
+            failure_dict[pnum] = failures # global, see parse_bags()
+        if word_counts is None:
+            parse_batch.record(pnum, 'failed', self.year_of_DL)
+        else:
+            save_raw_bag(pnum, word_counts) # staged in parse_batch
+            self.parsed.append(pnum)
+            parse_batch.record(pnum, 'parsed', self.year_of_DL)
+    
+    async def checkpoint(self):
+        'Commit the open batch in the writer thread, staging goes on in a new one'
+        import asyncio
+        global parse_batch
+        if self.committing: # one at a time, bounds the bags held in memory
+            await self.committing
+        batch, parse_batch = parse_batch, ParseBatch(self.manifest) # flushes batch's words and failures
+        self.committing = asyncio.create_task(self.commit(batch))
+    
+    async def commit(self, batch):
+        import asyncio
+        ayears = self.manifest.ayears([pnum for pnum, _, _ in batch.bags])
+        await asyncio.get_running_loop().run_in_executor(self.writer, batch.write, ayears)
+        ParseBatch.finish(batch.dir, self.manifest) # manifest stays on this thread
+    
+    async def close(self):
+        import asyncio
+        global parse_batch
+        await self.queue.put(None)
+        await self.consumer
+        if self.committing:
+            await self.committing
+        word_index.flush()
+        failure_dict.flush()
+        batch, parse_batch = parse_batch, None
+        await self.commit(batch)
+        await asyncio.gather(*self.archiving)
+        self.pool.shutdown()
+        self.writer.shutdown()
+
+
+def parse_page(pnum,html,year_of_DL):
+    '''
+    Process pool side of FusedParser: raw page bytes -> 
+    (pnum, {word: count} in order of first appearance or None, failures)
+    '''
+    from collections import Counter
+    words, failures = html_to_words(decode_html(html,year_of_DL),year_of_DL)
+    return pnum, (Counter(words) if words is not None else None), failures
+
+
+def download_and_parse(min_year=2019,max_year=2019,keep_html=True,n_parsers=None,
+                       queue_size=256):
+    '''
+    Fused alternative to download_patent_HTML() then parse_bags(): pages 
+    go straight from the downloader to a parser pool (see FusedParser), 
+    saving a full write+read of the html. 
+    
+    keep_html=False doesn't save the raw html at all (pnums with bags are 
+    then not downloaded again). Run parse_bags() afterwards to pick up pages 
+    that were downloaded earlier but never parsed.
+    '''
+    
+    import os, logging
+    from datetime import datetime
+    
+    bag_dir = '../data/word_bags/'
+    word_index_fname = os.path.join(bag_dir,'word_index.csv')
+    failure_fname    = os.path.join(bag_dir,'descriptONLY','parse_failures.csv')
+    log_fname        = os.path.join(bag_dir,'descriptONLY','logger.log')
+    os.makedirs(os.path.join(bag_dir,       'descriptONLY'), exist_ok=True)
+    
+    logging.basicConfig(level=logging.INFO,
+                        filename=log_fname,
+                        format='%(asctime)s - %(message)s')
+    
+    print('Figuring out what to DL')
+    
+    manifest = Manifest()
+    pnums_to_DL = manifest.to_download(min_year,max_year,skip_parsed=True)
+    
+    print('Pnums to DL and parse:',len(pnums_to_DL))
+    logging.info("Fused DL+parse for:  %i-%i" % (min_year,max_year))
+    logging.info("Pnums to DL:         %i" % (len(pnums_to_DL)))
+    
+    global word_index, failure_dict # see parse_bags()
+    
+    ParseBatch.recover(manifest)
+    
+    word_index   = load_word_index(word_index_fname)
+    failure_dict = load_failures(failure_fname)
+    
+    sink = FusedParser(datetime.now().year,n_workers=n_parsers,queue_size=queue_size,
+                       keep_html=keep_html,manifest=manifest)
     
+    download_gpg_pages(pnums_to_DL,html_store='none',manifest=manifest,page_sink=sink)
     
-def clean_bags(min_year,max_year):
+    word_index.compact()
+    failure_dict.compact()
+    manifest.close()
+    
+    print('We parsed',len(sink.parsed),'patents')
+    logging.info('Fused DL+parse made %i new bags' % len(sink.parsed))
+
+
+def clean_bags(min_year,max_year,buffer_bytes=2*1024**3,n_workers=1,max_memory=8*1024**3,
+               write_csv=False,incremental=False):
     """    
-    Update: This is MUCH more memory efficient than previous version, but reads
-    the raw patent count files twice instead of once.
+    Update: This is MUCH more memory efficient than previous version, and 
+    reads the raw bags once: each year's bags are read (through RawBagStore,
+    so packed shards are read sequentially, and any remaining per patent csv 
+    files still work) into int32 columns, which give the document 
+    frequencies (np.bincount) and then the cleaned bags. 
+    
+    Up to buffer_bytes of bags are held in memory (12 bytes per row), beyond
+    that they spill to a temp file that is read back sequentially.
     
-    As a result, the slowest years take about 8 hours on my computer, but <3GB
-    of memory is needed!
+    n_workers > 1 cleans that many years at once (clean_year() in a process 
+    pool), biggest years first, as long as their estimated memory fits in 
+    max_memory. Outputs are the same as one year at a time.
+    
+    incremental=True only reads the raw bags of patents added to a year 
+    since it was last cleaned (late grants), and folds them into its cleaned
+    bags and YearStats (update_cleaned_year). A year whose stopwords change
+    as a result is reported, and cleaned in full. 
     
     Inputs:
         
         1. word_index.csv, 
         2. all the word bags, 
         3. bad_ocr_words.csv
-        4. pat_dates_CURRENT.csv
+        4. pat_dates_CURRENT.csv (through the manifest)
+        5. nber_CURRENT.csv (for the YearStats class tallies, through PatentMeta)
         
     Key outputs are in data/words_bags/descriptONLY/wordspace:
         
@@ -1053,10 +2765,22 @@ def clean_bags(min_year,max_year):
          
     And in data/words_bags/descriptONLY/bags_cleaned_annualbatch_by_ayear:
             
-        bag_ayear_<YYYY>.csv
+        bag_ayear_<YYYY>.parquet
             DESCRIPT:   all of the word bags for patents applied for in year YYYY
                         after dropping short words, potential stopwords, and 
-                        bad ocr words
+                        bad ocr words (int32 pnum, word_index, count; load 
+                        with read_cleaned_bags)
+        
+        bag_ayear_<YYYY>.csv
+            same, if write_csv (or no pyarrow). or use export_cleaned_csv()
+
+    And in data/words_bags/descriptONLY/year_stats:
+        
+        stats_ayear_<YYYY>.npz
+            DESCRIPT:   the year's document frequencies, z_t sums and word x 
+                        nber class tallies (see YearStats), which make_RETech
+                        and make_breadth use instead of recomputing them
+            INPUT NEED: the cleaned bags, nber_CURRENT.csv
                 
     Notes:
     
@@ -1071,10 +2795,11 @@ def clean_bags(min_year,max_year):
     """
 
     import os, csv, logging
+    import numpy as np
     import pandas as pd 
     from datetime import datetime
     from tqdm import tqdm 
-    from collections import defaultdict
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
     
     # ======================================================================= #
     # %%   set up     
@@ -1109,7 +2834,15 @@ def clean_bags(min_year,max_year):
     # what years to clean (and thus what patents to clean)
     
     list_of_years = list(range(min_year,max_year+1))        
-    new_pat_dates = pd.read_csv('../data/patent_level_info/pat_dates_CURRENT.csv').query('ayear in @list_of_years').astype('int32')      
+    
+    # the manifest knows which patents have bags, and where they are
+    
+    store = RawBagStore(Manifest())
+    
+    # the nber arrays the YearStats use, rebuilt here if nber_CURRENT.csv 
+    # changed, not in each clean_year() worker
+    
+    PatentMeta().refresh()
         
     ##############################################################################
     #   CREATE short_words_to_drop.csv (updates off of new word_index)
@@ -1120,13 +2853,10 @@ def clean_bags(min_year,max_year):
     # Get the indices of short words (recreate incase word_index changed )
     short_word_indices = []
     
-    # Load the CSV file and filter rows with string length less than 4
-    with open(word_index_fname, 'r') as f_csv:
-        csv_reader = csv.reader(f_csv)
-        
-        for row in csv_reader:
-            if len(row[0]) < 4:
-                short_word_indices.append(int(row[1]))
+    # Load the word index (incl. its journal) and keep words shorter than 4
+    for word, idx in load_word_index(word_index_fname).items():
+        if len(word) < 4:
+            short_word_indices.append(idx)
     
     # put into df (to save, and bc code below was written using df)
     short_stop_ALLYEARS = pd.DataFrame({'word_index': short_word_indices})
@@ -1142,6 +2872,10 @@ def clean_bags(min_year,max_year):
     old_bad_ocr          = (pd.read_csv('../inputs/bad_ocr_words.csv',names=['word_index'],)
                             .astype('int32').sort_values('word_index')  )  
     
+    # words dropped every year, as a mask: is_dropped[word_index]
+    
+    always_purged = purge_mask([short_stop_ALLYEARS.word_index, old_bad_ocr.word_index])
+    
     ##############################################################################
     #   LOAD words used in >25% of patents in a year
     #
@@ -1177,108 +2911,666 @@ def clean_bags(min_year,max_year):
     
     logging.info("preliminaries complete, now cleaning+getting annual stopwords")
     
-    def pd_concat_subfunc(pnum):
-        '''
-        Helper function to quickly load many csv files into one df
-        
-        Example usage, two steps: (1) set list of pnums to load, (2) load pnums:
-            
-            pnums = range(9000000,9001000)
-            batch_pats = pd.concat(map(pd_concat_subfunc, pnums))       
+    # years are independent (clean_year), except for potential_stopwords.csv, 
+    # which is rewritten here as each year finishes. it is sorted, so the 
+    # result doesn't depend on which years finish first
     
-        This function accounts for the way patents are stored in this folder and
-        the possibility of missing patent files
-    
-        '''
-        p_path = f'{count_dir}/{str(pnum).zfill(8)[:4]}/count_{str(pnum)}.csv'
-        
-        if os.path.exists(p_path):          
-            # int32 will cover our needs, half the data of int64
-            return pd.read_csv(p_path, names=['word_index','count']).assign(pnum=pnum).astype('int32')  
-
-    def filter_data(batch):
-        'Efficient removal of rows of a df for our problem'
-        batch = batch[~batch['word_index'].isin(purge['word_index'])]
-        return batch[['pnum', 'word_index', 'count']].sort_values(['pnum', 'word_index'])
-
-    def write_to_csv(pnums, yyyy, batch_size=10000):
-        'In batches, load pnums and apply filtering, and save annual csv'
-        output_path = f'{batchdir}/bag_ayear_{yyyy}.csv'  # Replace with your desired output path
-        with open(output_path, 'w') as f:
-            for i in tqdm(range(0, len(pnums), batch_size),
-                          desc=f'Purging and saving word bags for {yyyy}',
-                          total = 1+len(pnums)//batch_size):
-                batch_pnums = pnums[i:i+batch_size]
-                batch_pats = pd.concat(map(pd_concat_subfunc, batch_pnums))
-                filtered_batch_pats = filter_data(batch_pats)
-                filtered_batch_pats.to_csv(f, index=False, header=(i == 0))
-    
-    for yyyy in list_of_years:
-        
-        pnums = new_pat_dates.query('ayear == @yyyy').pnum.to_list()
-
-        logging.info( "Finding annual stopwords for year: %i" %(yyyy) )
-        
-        # find this years stop words 
-        # ==> find out how many patents use a given word this year
-        # ==> load patent and increment dict = word_index:pnum_count
-        # this obj is, at max, size len(word_index) long by 2(pnum+count)
-    
-        n_pats = 0 # count the patents we've parsed
-        word_index_counts = defaultdict(int)
-        
-        for pnum in tqdm(pnums, desc='Getting stopwords'):
-            p_path = '../data/word_bags/descriptONLY/bags_raw_file_per_pat/' + \
-                     str(pnum).zfill(8)[:4] + '/count_' + str(pnum) + '.csv'
-                     
-            if os.path.exists(p_path):
-                n_pats += 1
-                with open(p_path, 'r') as f:
-                    reader = csv.reader(f)
-                    for row in reader:
-                        word_idx = int(row[0])  # word_index is the first column in csv
-                        word_index_counts[word_idx] += 1        
-                             
-        threshold = n_pats * 0.25
-        filtered_word_counts = {k: v for k, v in word_index_counts.items() if v >= threshold}
-        
-        # update the stopwords dataset 
-        
-        stopwords_this_year = pd.DataFrame({
-            'word_index': list(filtered_word_counts.keys()),
-            # 'frac': [count / n_pats for count in filtered_word_counts.values()]
-        }).assign(ayear=yyyy)
-
+    def save_stopwords(yyyy, stopwords_this_year):
+        nonlocal potential_stopwords
         potential_stopwords = (
-                  pd.concat([potential_stopwords,stopwords_this_year],ignore_index=True)
+                  pd.concat([potential_stopwords,
+                             pd.DataFrame({'word_index': stopwords_this_year}).assign(ayear=yyyy)],
+                            ignore_index=True)
                  .drop_duplicates(subset=['ayear','word_index'])
                  .sort_values(['ayear','word_index'])
                  )
+        # output potential stopwords             
+        potential_stopwords.to_csv(potential_stop_fname,
+                                    index=False)
+        logging.info('output of '+str(yyyy)+' complete')
+    
+    if n_workers == 1:
+        for yyyy in list_of_years:
+            save_stopwords(yyyy, clean_year(yyyy, always_purged, buffer_bytes, True, write_csv, incremental))
+    
+    else:
+        
+        # memory each year needs: its bags (12 bytes a row) up to buffer_bytes,
+        # plus doc_freq and the purge mask. patents with csv bags are guessed
+        # at the average packed bag size
+        
+        sizes    = store.manifest.bag_rows(min_year, max_year)
+        n_packed = sum(n - n_csv for n, n_csv, _ in sizes.values())
+        avg_rows = sum(rows for _, _, rows in sizes.values()) / n_packed if n_packed else 500
+        need     = {y: 9*len(always_purged) for y in list_of_years}
+        for y, (_, n_csv, rows) in sizes.items():
+            need[y] += min(buffer_bytes, int(12*(rows + avg_rows*n_csv)))
+        
+        # biggest years first, start a year if its memory fits under 
+        # max_memory (or if nothing is running)
+        
+        todo    = sorted(list_of_years, key=lambda y: -need[y])
+        running = {} # future: year
+        with ProcessPoolExecutor(n_workers) as pool:
+            while todo or running:
+                used = sum(need[y] for y in running.values())
+                fits = [y for y in todo if used + need[y] <= max_memory]
+                if len(running) < n_workers and (fits or not running):
+                    yyyy = fits[0] if fits else todo[0]
+                    todo.remove(yyyy)
+                    logging.info("Cleaning %i in parallel, est. memory %i MB" % (yyyy, need[yyyy]//2**20))
+                    running[pool.submit(clean_year, yyyy, always_purged, buffer_bytes, False, write_csv,
+                                        incremental)] = yyyy
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in sorted(done, key=lambda f: running[f]):
+                    save_stopwords(running.pop(fut), fut.result())
+    
+    store.manifest.close()
 
-        # this is the total set of word_indices to drop:
 
-        purge = (pd.concat([stopwords_this_year[['word_index']],short_stop_ALLYEARS,old_bad_ocr])
-                 .drop_duplicates('word_index')
-                 .sort_values('word_index'))
-                
-        logging.info('stopwords_this_year figured')
+def load_bag_year(store, yyyy, buffer_bytes=2*1024**3, batch_size=25000, progress=True,
+                  pnums=None):
+    '''
+    Read the raw bags of yyyy ONCE. Returns (n_pats, doc_freq, batches): 
+    doc_freq[word_index] = # patents using the word, and batches yields 
+    the (3, rows) int32 columns (pnum, word_index, count) again, 
+    batch_size patents at a time. Batches are kept in memory up to 
+    buffer_bytes, after that they spill to a temp file (np.save'd one 
+    after the other, and read back in order). pnums: only these patents.
+    '''
+    import os, logging, tempfile
+    import numpy as np
+    from tqdm import tqdm
+    
+    n_pats, doc_freq = 0, np.zeros(0, dtype=np.int64)
+    held, held_bytes, spill, n_spilled = [], 0, None, 0
+    
+    for batch, columns in tqdm(store.scan(yyyy, batch_size, pnums), desc=f'Reading raw bags for {yyyy}',
+                               disable=not progress):
+        n_pats += len(batch)
+        # a word appears at most once per bag, so rows per word = # patents using it 
+        counts = np.bincount(columns[1])
+        if len(counts) > len(doc_freq):
+            doc_freq = np.pad(doc_freq, (0, len(counts) - len(doc_freq)))
+        doc_freq[:len(counts)] += counts
+        
+        if spill is None and held_bytes + columns.nbytes > buffer_bytes:
+            logging.info("Over buffer_bytes, spilling %i to disk" % yyyy)
+            spill = tempfile.TemporaryFile(dir=os.path.join(store.bag_dir,'descriptONLY'))
+            for held_columns in held:
+                np.save(spill, held_columns)
+            n_spilled, held = len(held), []
+        if spill is None:
+            held.append(columns)
+            held_bytes += columns.nbytes
+        else:
+            np.save(spill, columns)
+            n_spilled += 1
+    
+    def batches():
+        yield from held
+        if spill is not None:
+            spill.seek(0)
+            for _ in range(n_spilled):
+                yield np.load(spill)
+            spill.close()
+    
+    return n_pats, doc_freq, batches()
+
+
+def clean_year(yyyy, always_purged, buffer_bytes=2*1024**3, progress=True, write_csv=False,
+               incremental=False):
+    '''
+    One year of clean_bags(): find the year's stopwords (words in >= 25% of 
+    its patents), and write bag_ayear_<yyyy>.parquet (see CleanedBagWriter)
+    without them and the words in always_purged (a purge_mask), and its 
+    YearStats. Returns the stopwords' word_index array. Runs in a worker 
+    process when clean_bags() is parallel.
+    
+    incremental=True tries update_cleaned_year() first, and only cleans 
+    the whole year if it can't be updated.
+    '''
+    import os, logging
+    import numpy as np
+    from tqdm import tqdm
+    
+    store    = RawBagStore(Manifest())
+    
+    if incremental:
+        stopwords_this_year = update_cleaned_year(store, yyyy, always_purged, buffer_bytes, 
+                                                  progress, write_csv)
+        if stopwords_this_year is not None:
+            store.manifest.close()
+            return stopwords_this_year
+    
+    logging.info( "Finding annual stopwords for year: %i" %(yyyy) )
+    
+    # find this years stop words 
+    # ==> find out how many patents use a given word this year
+    # ==> doc_freq is len(word_index) long, the bags are kept for the output
+
+    n_pats, doc_freq, batches = load_bag_year(store, yyyy, buffer_bytes, progress=progress)
+                         
+    stopwords_this_year = annual_stopwords(n_pats, doc_freq)
+
+    # this is the total set of word_indices to drop (a mask by word_index):
+
+    purge = purge_mask([stopwords_this_year], size=len(doc_freq), base=always_purged)
             
-        # now, load and clean
+    logging.info('stopwords_this_year figured')
         
-        logging.info( "outputting cleaned word_bags for year: %i" %(yyyy) )
+    # now, load and clean
+    
+    logging.info( "outputting cleaned word_bags for year: %i" %(yyyy) )
+
+    YearStats.remove(yyyy) # the old stats don't describe the new bags
+    stats = YearStats(yyyy, load_nber_arrays())
+    stats.n_pats_raw, stats.doc_freq = n_pats, doc_freq
+    stats.pnums = np.array([loc[0] for loc in store.manifest.bag_locations(yyyy)], dtype=np.int64)
+    stats.nber_sha1 = stats.nber_digest()
+    
+    writer = CleanedBagWriter(yyyy, write_csv)
+    for columns in tqdm(batches, desc=f'Purging and saving word bags for {yyyy}', disable=not progress):
+        # int32 will cover our needs, half the data of int64
+        columns = filter_bags(columns, purge)
+        writer.write(columns)
+        stats.add(columns)
+    writer.close()
+    stats.save()
+    
+    store.manifest.close()
+    
+    return stopwords_this_year
+
+
+def annual_stopwords(n_pats, doc_freq):
+    'word_index of the words used in >= 25% of the year\'s n_pats patents'
+    import numpy as np
+    return np.flatnonzero((doc_freq >= n_pats * 0.25) & (doc_freq > 0))
+
+
+def update_cleaned_year(store, yyyy, always_purged, buffer_bytes=2*1024**3, progress=True,
+                        write_csv=False):
+    '''
+    Fold patents parsed since yyyy was last cleaned (late grants) into its 
+    cleaned bags and YearStats, reading only their raw bags: the doc_freq 
+    and z_sum running sums and the class tallies are added to, and the new 
+    cleaned bags are merged into bag_ayear_<yyyy>.parquet in pnum order.
+    
+    Returns the year's stopwords, or None if the whole year has to be 
+    cleaned again: no YearStats (with pnums and nber_sha1) or parquet from 
+    an earlier clean, patents that left the year (or lost their bags), a new
+    nber code, a changed nber code of a patent already in the year (e.g. 
+    update_pat_nber_class() filled in a missing one), or a changed stopword
+    set (more patents moves the 25% threshold).
+    '''
+    import os, logging
+    import numpy as np
+    from tqdm import tqdm
+    
+    stats = YearStats.load(yyyy)
+    parquet = os.path.join(CleanedBagWriter.batchdir, f'bag_ayear_{yyyy}.parquet')
+    if stats is None or stats.pnums is None or stats.nber_sha1 is None or not os.path.exists(parquet):
+        logging.info("%i has no stats from an earlier clean, cleaning all of it" % yyyy)
+        return None
+    
+    pnums = np.array([loc[0] for loc in store.manifest.bag_locations(yyyy)], dtype=np.int64)
+    if not np.isin(stats.pnums, pnums).all():
+        logging.info("Patents left %i since it was cleaned, cleaning all of it" % yyyy)
+        return None
+    new = np.setdiff1d(pnums, stats.pnums)
+    
+    old_stopwords = annual_stopwords(stats.n_pats_raw, stats.doc_freq)
+    if not len(new):
+        logging.info("No new patents in %i, its cleaned bags are up to date" % yyyy)
+        return old_stopwords
+    
+    # the new patents' raw bags only
+    
+    n_new, doc_freq, batches = load_bag_year(store, yyyy, buffer_bytes, progress=progress, pnums=new)
+    
+    size     = max(len(doc_freq), len(stats.doc_freq))
+    doc_freq = np.pad(doc_freq, (0, size-len(doc_freq))) + np.pad(stats.doc_freq, (0, size-len(stats.doc_freq)))
+    n_pats   = stats.n_pats_raw + n_new
+    
+    stopwords_this_year = annual_stopwords(n_pats, doc_freq)
+    if not np.array_equal(stopwords_this_year, old_stopwords):
+        msg = ("Stopwords of %i changed with %i new patents (%i added, %i dropped), cleaning all of it" 
+               % (yyyy, n_new, len(np.setdiff1d(stopwords_this_year, old_stopwords)), 
+                  len(np.setdiff1d(old_stopwords, stopwords_this_year))))
+        print(msg)
+        logging.info(msg)
+        return None
+    
+    stats.nber = load_nber_arrays()
+    if not np.isin(np.unique(stats.nber[1]), stats.classes).all():
+        logging.info("New nber codes since %i was cleaned, cleaning all of it" % yyyy)
+        return None
+    if stats.nber_digest() != stats.nber_sha1:
+        logging.info("Nber codes of patents in %i changed since it was cleaned, cleaning all of it" % yyyy)
+        return None
+    
+    logging.info("Adding %i new patents to the cleaned bags of %i" % (n_new, yyyy))
+    
+    purge   = purge_mask([stopwords_this_year], size=size, base=always_purged)
+    added   = [filter_bags(columns, purge) for columns in batches]
+    added   = np.concatenate(added, axis=1) if added else np.empty((3, 0), dtype=np.int32)
+    stats.add(added)
+    stats.n_pats_raw, stats.doc_freq, stats.pnums = n_pats, doc_freq, pnums
+    stats.nber_sha1 = stats.nber_digest()
+    
+    # merge into the cleaned bags: each old batch takes the new rows up to 
+    # its last pnum. if we die before stats.save(), there are no stats, so 
+    # the next run cleans the whole year 
+    
+    YearStats.remove(yyyy)
+    writer = CleanedBagWriter(yyyy, write_csv)
+    done   = 0
+    for columns in tqdm(iter_cleaned_bags(yyyy), desc=f'Merging new word bags into {yyyy}', 
+                        disable=not progress):
+        upto = np.searchsorted(added[0], columns[0, -1], 'right') if columns.shape[1] else done
+        if upto > done:
+            columns = filter_bags(np.concatenate([columns, added[:, done:upto]], axis=1), purge)
+            done    = upto
+        writer.write(columns)
+    if done < added.shape[1]:
+        writer.write(added[:, done:])
+    writer.close()
+    stats.save()
+    
+    return stopwords_this_year
+
+
+class CleanedBagWriter:
+    """
+    Writes one ayear of cleaned bags, batch by batch, as 
+    bags_cleaned_annualbatch_by_ayear/bag_ayear_<yyyy>.parquet: int32 pnum, 
+    word_index and count columns, in pnum order, one row group per batch 
+    (so the row group min/max stats let readers skip to a pnum range, see 
+    read_cleaned_bags). Needs pyarrow, without it this writes the csv.
+    
+    write_csv also (or only, without pyarrow) writes bag_ayear_<yyyy>.csv, 
+    the old format, for Stata. export_cleaned_csv() makes it later.
+    """
+    
+    batchdir = '../data/word_bags/descriptONLY/bags_cleaned_annualbatch_by_ayear/'
+    
+    def __init__(self, yyyy, write_csv=False):
+        import os
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            pa = None
+        self.path  = os.path.join(self.batchdir, f'bag_ayear_{yyyy}.parquet')
+        self.csv   = os.path.join(self.batchdir, f'bag_ayear_{yyyy}.csv')
+        self.f_csv = open(self.csv, 'w') if write_csv or pa is None else None
+        self.pq    = None
+        if pa is not None:
+            self.pa     = pa
+            self.schema = pa.schema([(c, pa.int32()) for c in RawBagStore.COLUMNS])
+            self.pq     = pq.ParquetWriter(self.path + '.tmp', self.schema)
+        self.n_batches = 0
+    
+    def write(self, columns):
+        '(3, rows) int32 columns: pnum, word_index, count. Empty batches are skipped'
+        import pandas as pd
+        if not columns.shape[1]:
+            return
+        if self.pq is not None:
+            self.pq.write_table(self.pa.Table.from_arrays(list(columns), schema=self.schema))
+        if self.f_csv is not None:
+            pd.DataFrame(dict(zip(RawBagStore.COLUMNS, columns))).to_csv(self.f_csv, index=False, 
+                                                                        header=(self.n_batches == 0))
+        self.n_batches += 1
+    
+    def close(self):
+        import os, logging
+        if self.pq is not None:
+            self.pq.close()
+            os.replace(self.path + '.tmp', self.path)
+            if self.f_csv is None and os.path.exists(self.csv): # stale, from an older run
+                logging.info("Removing old %s, the .parquet replaces it" % self.csv)
+                os.remove(self.csv)
+        if self.f_csv is not None:
+            if self.n_batches == 0:
+                self.f_csv.write(','.join(RawBagStore.COLUMNS) + '\n')
+            self.f_csv.close()
+
+
+def read_cleaned_bags(yyyy, columns=None, pnum_range=None):
+    '''
+    Load the cleaned bags of ayear yyyy as a DataFrame of int32 columns 
+    (pnum, word_index, count), from bag_ayear_<yyyy>.parquet, or the csv if 
+    that's all there is. 
+    
+    columns:    only load these columns
+    pnum_range: (lo, hi), only load pnums in [lo, hi]. With parquet, only 
+                the row groups whose pnum stats overlap it are read.
+    '''
+    import os
+    import pandas as pd
+    
+    path = os.path.join(CleanedBagWriter.batchdir, f'bag_ayear_{yyyy}')
     
-        write_to_csv(pnums, yyyy, 25000)
+    if os.path.exists(path + '.parquet'):
+        import pyarrow.parquet as pq
+        filters = None if pnum_range is None else [('pnum','>=',pnum_range[0]), ('pnum','<=',pnum_range[1])]
+        return pq.read_table(path + '.parquet', columns=columns, filters=filters).to_pandas()
+    
+    usecols = None if columns is None else sorted(set(columns) | ({'pnum'} if pnum_range else set()))
+    bags    = pd.read_csv(path + '.csv', usecols=usecols, dtype='int32')
+    if pnum_range is not None:
+        bags = bags[bags.pnum.between(*pnum_range)].reset_index(drop=True)
+    return bags if columns is None else bags[list(columns)]
+
+
+def iter_cleaned_bags(yyyy, max_rows=None):
+    '''
+    The cleaned bags of ayear yyyy as (3, rows) int32 columns (pnum, 
+    word_index, count), in pnum order, about a parquet row group at a time
+    (one clean_bags batch), or about max_rows rows at a time (csv: 5 
+    million by default). Batches hold whole patents.
+    '''
+    import os
+    import numpy as np
+    import pandas as pd
+    
+    path = os.path.join(CleanedBagWriter.batchdir, f'bag_ayear_{yyyy}')
+    
+    if os.path.exists(path + '.parquet'):
+        import pyarrow.parquet as pq
+        f = pq.ParquetFile(path + '.parquet')
+        if max_rows is None:
+            tables = (f.read_row_group(i, columns=list(RawBagStore.COLUMNS)) for i in range(f.num_row_groups))
+        else:
+            tables = f.iter_batches(batch_size=max_rows, columns=list(RawBagStore.COLUMNS))
+        chunks = (np.vstack([table.column(i).to_numpy() for i in range(3)]).astype(np.int32)
+                  for table in tables)
+    else:
+        chunks = (chunk[list(RawBagStore.COLUMNS)].values.T 
+                  for chunk in pd.read_csv(path + '.csv', dtype='int32', chunksize=max_rows or 5*10**6))
+    
+    # the last patent of a chunk may continue in the next one
+    rest = np.empty((3, 0), dtype=np.int32)
+    for chunk in chunks:
+        if not chunk.shape[1]:
+            continue
+        columns = np.concatenate([rest, chunk], axis=1) if rest.shape[1] else chunk
+        split   = np.searchsorted(columns[0], columns[0, -1], 'left')
+        rest    = columns[:, split:]
+        if split:
+            yield columns[:, :split]
+    if rest.shape[1]:
+        yield rest
+
+
+def export_cleaned_csv(min_year, max_year):
+    'Write bag_ayear_<yyyy>.csv from the .parquet cleaned bags (for Stata)'
+    import os
+    from tqdm import tqdm
+    for yyyy in tqdm(range(min_year, max_year+1), desc='Exporting cleaned bags to csv'):
+        path = os.path.join(CleanedBagWriter.batchdir, f'bag_ayear_{yyyy}')
+        if os.path.exists(path + '.parquet'):
+            read_cleaned_bags(yyyy).to_csv(path + '.csv', index=False)
+
+
+class YearStats:
+    """
+    Per-year corpus statistics, written by clean_year() next to the cleaned 
+    bags as descriptONLY/year_stats/stats_ayear_<yyyy>.npz, so the measures 
+    don't have to re-derive them from the bags:
+    
+        pnums       - the patents with a raw bag (sorted)
+        n_pats_raw  - # of them (the stopword threshold basis)
+        doc_freq    - [word_index] # of those patents using the word
+        n_pats      - # patents in the cleaned bags
+        z_sum       - [word_index] the sum, over cleaned patents, of the 
+                      word's share of the patent's words. z_t (RETech eq. 1)
+                      is z_sum / z_sum.sum()
+        classes     - the nber codes (sorted), from nber_CURRENT.csv
+        ccnt, ncnt  - [word_index, class] # of the class's patents using the
+                      word, and the total count of the word in them (the 
+                      word x class table make_breadth() starts from)
+        nber_sha1   - the nber codes of pnums, hashed (see nber_digest)
+    
+    Arrays are dense, keyed by word id. add() accumulates a batch of cleaned
+    bags, so the stats are built while the bags are written, and patents 
+    can be added later (update_cleaned_year). The class tallies use the 
+    nber codes a patent had when it was added, so update_cleaned_year() 
+    cleans the whole year again if nber_sha1 shows that 
+    update_pat_nber_class() changed them.
+    """
+    
+    statsdir = '../data/word_bags/descriptONLY/year_stats/'
+    
+    def __init__(self, yyyy, nber=None):
+        '''
+        nber: (pnums, codes) arrays sorted by pnum (see load_nber_arrays), 
+        needed by add() for the class tallies
+        '''
+        import numpy as np
+        self.yyyy       = yyyy
+        self.nber       = nber
+        self.pnums      = None
+        self.n_pats_raw = 0
+        self.doc_freq   = np.zeros(0, dtype=np.int64)
+        self.n_pats     = 0
+        self.z_sum      = np.zeros(0)
+        self.classes    = np.unique(nber[1]) if nber is not None else np.zeros(0)
+        self.ccnt       = np.zeros((0, len(self.classes)), dtype=np.int64)
+        self.ncnt       = np.zeros((0, len(self.classes)), dtype=np.int64)
+        self.nber_sha1  = None
         
-        logging.info('output of '+str(yyyy)+' complete')
+    @classmethod
+    def path(cls, yyyy):
+        import os
+        return os.path.join(cls.statsdir, f'stats_ayear_{yyyy}.npz')
+    
+    def grow(self, size):
+        'Make the word_index arrays at least size long'
+        import numpy as np
+        if size > len(self.z_sum):
+            self.z_sum = np.pad(self.z_sum, (0, size - len(self.z_sum)))
+            self.ccnt  = np.pad(self.ccnt, ((0, size - len(self.ccnt)), (0, 0)))
+            self.ncnt  = np.pad(self.ncnt, ((0, size - len(self.ncnt)), (0, 0)))
+    
+    def add(self, columns):
+        '(3, rows) int32 cleaned bags: pnum, word_index, count, in pnum order'
+        import numpy as np
+        pnum, words, count = columns
+        if not len(pnum):
+            return
+        self.grow(int(words.max()) + 1)
         
-        # output potential stopwords             
-        potential_stopwords.to_csv(potential_stop_fname,
-                                    index=False)
+        # z: each row's share of its patent's words
+        starts = np.flatnonzero(np.r_[True, pnum[1:] != pnum[:-1]])
+        totals = np.add.reduceat(count.astype(np.float64), starts)
+        shares = count / np.repeat(totals, np.diff(np.r_[starts, len(pnum)]))
+        self.n_pats += len(starts)
+        self.z_sum  += np.bincount(words, weights=shares, minlength=len(self.z_sum))
+        
+        # word x class: each row once per nber code of its patent
+        if self.nber is not None and len(self.classes):
+            nber_pnums, codes = self.nber
+            lo = np.searchsorted(nber_pnums, pnum, 'left')
+            n  = np.searchsorted(nber_pnums, pnum, 'right') - lo
+            rows  = np.repeat(np.arange(len(pnum)), n)
+            which = np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())
+            cell  = words[rows].astype(np.int64)*len(self.classes) + np.searchsorted(self.classes, codes[which])
+            size  = self.ccnt.size
+            self.ccnt += np.bincount(cell, minlength=size).reshape(self.ccnt.shape)
+            self.ncnt += np.bincount(cell, weights=count[rows], minlength=size).astype(np.int64).reshape(self.ncnt.shape)
+    
+    def nber_digest(self):
+        'sha1 of the (pnum, code) rows of self.nber for the patents in self.pnums'
+        import hashlib
+        import numpy as np
+        nber_pnums, codes = self.nber
+        keep = np.isin(nber_pnums, self.pnums)
+        sha1 = hashlib.sha1(np.ascontiguousarray(nber_pnums[keep], dtype=np.int64).tobytes())
+        sha1.update(np.ascontiguousarray(codes[keep], dtype=np.float64).tobytes())
+        return sha1.hexdigest()
+    
+    @property
+    def z(self):
+        'z_t, RETech equation 1'
+        return self.z_sum / self.z_sum.sum()
+    
+    def tallies(self):
+        '''
+        The word x class table as a DataFrame (word_index, coarse, ccnt, 
+        ncnt) of the nonzero cells, sorted by word_index then coarse (like 
+        the groupby it replaces in make_breadth)
+        '''
+        import numpy as np
+        import pandas as pd
+        words, k = np.nonzero(self.ccnt)
+        return pd.DataFrame({'word_index': words, 'coarse': self.classes[k],
+                             'ccnt': self.ccnt[words, k], 'ncnt': self.ncnt[words, k]})
+    
+    def save(self):
+        'Write to .tmp and rename'
+        import os
+        import numpy as np
+        os.makedirs(self.statsdir, exist_ok=True)
+        with open(self.path(self.yyyy) + '.tmp', 'wb') as f:
+            np.savez_compressed(f, n_pats_raw=self.n_pats_raw, doc_freq=self.doc_freq,
+                                n_pats=self.n_pats, z_sum=self.z_sum, classes=self.classes,
+                                ccnt=self.ccnt, ncnt=self.ncnt,
+                                **({} if self.pnums is None else {'pnums': self.pnums}),
+                                **({} if self.nber_sha1 is None else {'nber_sha1': self.nber_sha1}))
+        os.replace(self.path(self.yyyy) + '.tmp', self.path(self.yyyy))
+    
+    @classmethod
+    def load(cls, yyyy, skip=()):
+        '''
+        The stats of yyyy, or None if clean_bags() has not written them. 
+        Arrays in skip (e.g. doc_freq) aren't loaded.
+        '''
+        import os
+        import numpy as np
+        if not os.path.exists(cls.path(yyyy)):
+            return None
+        stats = cls(yyyy)
+        with np.load(cls.path(yyyy)) as f:
+            for key in f.files:
+                if key not in skip:
+                    setattr(stats, key, f[key])
+        stats.n_pats_raw, stats.n_pats = int(stats.n_pats_raw), int(stats.n_pats)
+        if stats.nber_sha1 is not None:
+            stats.nber_sha1 = str(stats.nber_sha1)
+        return stats
+    
+    @classmethod
+    def remove(cls, yyyy):
+        import os
+        if os.path.exists(cls.path(yyyy)):
+            os.remove(cls.path(yyyy))
+
+
+def load_nber_arrays(info_dir='../data/patent_level_info'):
+    '''
+    (pnums, nber codes) arrays sorted by pnum, rows with no code dropped
+    (memory mapped from PatentMeta)
+    '''
+    return PatentMeta(info_dir).nber()
+
+
+def purge_mask(word_index_lists, size=0, base=None):
+    '''
+    Boolean array, mask[word_index] is True for words in any of the lists 
+    (or in base, another mask). At least size long.
+    '''
+    import numpy as np
+    arrays = [np.asarray(ids, dtype=np.int64) for ids in word_index_lists]
+    size   = max([size, 0 if base is None else len(base)] + [ids.max()+1 for ids in arrays if len(ids)])
+    mask   = np.zeros(size, dtype=bool)
+    if base is not None:
+        mask[:len(base)] = base
+    for ids in arrays:
+        mask[ids] = True
+    return mask
 
 
+def filter_bags(columns, mask):
+    '''
+    Drop the rows of (3, rows) bag columns (pnum, word_index, count) whose 
+    word is in the purge mask, and put them in (pnum, word_index) order. 
+    The sort is skipped when the rows are already ordered (the usual case for
+    packed raw bags), and is only within patents if the pnums are ordered.
+    '''
+    import numpy as np
+    columns = columns[:, ~mask[columns[1]]]
+    d_pnum  = np.diff(columns[0])
+    d_word  = np.diff(columns[1])
+    if np.all((d_pnum > 0) | ((d_pnum == 0) & (d_word > 0))):
+        return columns
+    if np.all(d_pnum >= 0):
+        group = np.concatenate([[0], np.cumsum(d_pnum > 0)])
+        order = np.argsort(group * (int(columns[1].max()) + 1) + columns[1])
+    else:
+        order = np.lexsort((columns[1], columns[0]))
+    return columns[:, order]
+
+
+def benchmark_purge_filter(ayear, repeats=3):
+    '''
+    Time the clean_bags() filtering step for one ayear: the old way 
+    (DataFrame isin against a purge DataFrame rebuilt with concat/
+    drop_duplicates/sort, then sort_values) against purge_mask() + 
+    filter_bags(). Both get the same bags (read once, up front) and the 
+    same words to purge (short words, bad ocr, and this year's stopwords).
+    Checks that the outputs agree.
+    '''
+    import time
+    import numpy as np
+    import pandas as pd
+    
+    store   = RawBagStore(Manifest())
+    batches = [columns for _, columns in store.scan(ayear)]
+    store.manifest.close()
+    n_pats  = sum(len(np.unique(columns[0])) for columns in batches)
     
-      
-def make_RETech(outf,beg=1910,end=2010):
+    doc_freq  = np.bincount(np.concatenate([columns[1] for columns in batches]))
+    stopwords = pd.DataFrame({'word_index': np.flatnonzero(doc_freq >= n_pats*0.25)})
+    short     = pd.DataFrame({'word_index': [i for w, i in load_word_index().items() if len(w) < 4]})
+    bad_ocr   = pd.read_csv('../inputs/bad_ocr_words.csv',names=['word_index']).astype('int32')
+    
+    def old():
+        purge = (pd.concat([stopwords,short,bad_ocr])
+                 .drop_duplicates('word_index')
+                 .sort_values('word_index'))
+        out = []
+        for columns in batches:
+            batch = pd.DataFrame(dict(zip(RawBagStore.COLUMNS, columns)))
+            batch = batch[~batch['word_index'].isin(purge['word_index'])]
+            out.append(batch[['pnum', 'word_index', 'count']].sort_values(['pnum', 'word_index']).values)
+        return out
+    
+    def new():
+        mask = purge_mask([short.word_index, bad_ocr.word_index])
+        mask = purge_mask([stopwords.word_index], size=len(doc_freq), base=mask)
+        return [filter_bags(columns, mask).T for columns in batches]
+    
+    results = {}
+    for name, func in (('isin+sort_values', old), ('mask+filter_bags', new)):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            out = func()
+            times.append(time.perf_counter() - start)
+        results[name] = out
+        print('%-18s %8.3f sec (best of %i), %i patents, %i rows in' 
+              % (name, min(times), repeats, n_pats, sum(c.shape[1] for c in batches)))
+    
+    same = all(np.array_equal(a, b) for a, b in zip(*results.values()))
+    print('Same output:', same)
+    return same
+
+
+def make_RETech(outf,beg=1910,end=2010,engine='sparse',previous=None,max_memory=None,n_workers=1):
     '''
     Parameters
     ----------
@@ -1288,6 +3580,24 @@ def make_RETech(outf,beg=1910,end=2010):
         What year to start? The default is 1929.
     end : int, optional
         What year to start? The default is 2010.        
+    engine : str, optional
+        'sparse' (default) does equations 1-3 on a patent x word CSR matrix 
+        per batch of patents (RETechMeasure: bags_to_csr, retech_delta, 
+        retech_scores), with z_t from the year's YearStats. 
+        'pandas' is the original groupby/merge version. They agree to 1e-9 
+        (check_RETech_engines).
+    previous : str, optional
+        An earlier RETech csv (can be outf). RETech(t) only depends on the 
+        cleaned bags of t-1 and t, so the rows of years whose two cleaned 
+        years haven't changed since it was written (e.g. after clean_bags(
+        incremental=True) added late grants to a few years) are copied from
+        it, and only the other years are scored. Sparse engine only.
+    max_memory : int, optional
+        Bytes. The sparse engine scores each year in batches of patents 
+        sized to fit (see run_measures). The pandas engine loads whole years.
+    n_workers : int, optional
+        The sparse engine scores that many years at once, in a process 
+        pool (same output).
 
     Returns
     -------
@@ -1295,7 +3605,8 @@ def make_RETech(outf,beg=1910,end=2010):
     
     Inputs: 
         
-        Annual csvs with (pnum, word_index, nwords) for all pnums in a given year.
+        Annual cleaned bags with (pnum, word_index, nwords) for all pnums in a 
+        given year (see read_cleaned_bags).
         We sort by application year to more closely match the timing of the 
         invention. 
         
@@ -1312,9 +3623,17 @@ def make_RETech(outf,beg=1910,end=2010):
     import pandas as pd
     import os
 
+    if engine == 'sparse':
+        
+        # streams the bags a batch at a time, only z(t-1) (a vector over 
+        # word_index) is kept between years, see RETechMeasure 
+        
+        run_measures([RETechMeasure(outf, previous)], beg, end, max_memory, n_workers)
+        return
+    
     os.makedirs(os.path.dirname(outf) ,exist_ok=True)
 
-    big_RETech = pd.DataFrame() # we will store results in this           
+    big_RETech = AppendingCSV(outf) # we will store results in this, a year at a time
         
     for yyyy in trange(beg-1,end+1,desc='Making RETech...'): 
         
@@ -1327,9 +3646,7 @@ def make_RETech(outf,beg=1910,end=2010):
     
         # load cleaned bagOwords (contains all Vjt for this t) 
         
-        batchdir = '../data/word_bags/descriptONLY/bags_cleaned_annualbatch_by_ayear/'
-
-        bagOwords = pd.read_csv(batchdir + 'bag_ayear_'+str(yyyy)+'.csv',)
+        bagOwords = read_cleaned_bags(yyyy, columns=['pnum','word_index','count'])
         bagOwords.columns = ['pnum','word_index','nwords']
         
         # create this year's agg vector (zt, equation 1 in the paper)
@@ -1374,12 +3691,172 @@ def make_RETech(outf,beg=1910,end=2010):
                         )
             
             # append RETech for year t to existing
-            big_RETech = pd.concat([big_RETech,RETech],ignore_index=True)
+            big_RETech.write(RETech)
+            del RETech, delta
+        
+        del bagOwords # before the next year is loaded
             
-    big_RETech.to_csv(outf,index=False)   
+    big_RETech.close()
+    
+
+class AppendingCSV:
+    """
+    Output csv written a chunk at a time (the same file as pd.concat of the 
+    chunks, then to_csv), instead of concatenating an ever growing DataFrame.
+    Written to outf.tmp, and renamed to outf by close().
+    """
+    
+    def __init__(self, outf):
+        self.outf   = outf
+        self.f      = open(outf + '.tmp', 'w', newline='')
+        self.header = True
+    
+    def write(self, df):
+        df.to_csv(self.f, index=False, header=self.header)
+        self.header = False
+    
+    def copy(self, fname, start, stop):
+        'Copy bytes [start, stop) of an earlier output (and its header line)'
+        with open(fname, 'rb') as f:
+            if self.header:
+                self.f.write(f.readline().decode())
+                self.header = False
+            f.seek(start)
+            self.f.write(f.read(stop - start).decode())
+    
+    def close(self):
+        import os
+        if self.header: # nothing was written
+            self.f.write('\n')
+        self.f.close()
+        os.replace(self.outf + '.tmp', self.outf)
+
+
+def year_z(yyyy):
+    'z_t of yyyy, from its YearStats, else from its cleaned bags'
+    stats = YearStats.load(yyyy, skip=('doc_freq','pnums','ccnt','ncnt'))
+    if stats is None:
+        stats = YearStats(yyyy)
+        for columns in iter_cleaned_bags(yyyy):
+            stats.add(columns)
+    return stats.z
+
+
+def reusable_RETech_years(previous, beg, end):
+    '''
+    {year: (start, stop)}: the years in beg-end whose rows in previous (an 
+    earlier make_RETech csv, at bytes [start, stop)) are still right, ie 
+    neither their nor the prior year's cleaned bags or YearStats have been 
+    written since previous was.
+    '''
+    import os, glob
+    
+    if not os.path.exists(previous):
+        return {}
+    written = os.path.getmtime(previous)
+    
+    def changed(yyyy):
+        files = (glob.glob(os.path.join(CleanedBagWriter.batchdir, f'bag_ayear_{yyyy}.*')) 
+                 + glob.glob(YearStats.path(yyyy)))
+        return any(os.path.getmtime(f) >= written for f in files)
+    
+    # byte range of each year's rows (the year is the last column)
+    blocks = {}
+    with open(previous, 'rb') as f:
+        f.readline()
+        pos = f.tell()
+        for line in f:
+            yyyy = int(line.rsplit(b',', 1)[1])
+            start, _ = blocks.get(yyyy, (pos, pos))
+            blocks[yyyy] = (start, pos + len(line))
+            pos += len(line)
+    
+    return {yyyy: rows for yyyy, rows in blocks.items()
+            if beg <= yyyy <= end and not changed(yyyy) and not changed(yyyy-1)}
+
+
+def bags_to_csr(pnum, word_index, count):
+    '''
+    Cleaned bag columns (pnum, word_index, count) -> (pnums, X): X is a 
+    scipy.sparse CSR matrix with a row per patent (in pnums order, sorted) 
+    and a column per word_index, X[j, w] = count.
+    '''
+    import numpy as np
+    from scipy import sparse
+    pnums, rows = np.unique(pnum, return_inverse=True)
+    X = sparse.csr_matrix((count.astype(np.float64), (rows, word_index)),
+                          shape=(len(pnums), int(word_index.max())+1 if len(word_index) else 0))
+    return pnums, X
+
+
+def retech_z(X):
+    '''
+    z_t (equation 1): normalize each patent's counts to shares, sum the 
+    shares by word, divide by the total. Dense, indexed by word_index.
+    '''
+    import numpy as np
+    shares = X.data / np.repeat(np.asarray(X.sum(axis=1)).ravel(), np.diff(X.indptr))
+    z = np.bincount(X.indices, weights=shares, minlength=X.shape[1])
+    return z / z.sum()
+
 
-def make_breadth(outf,beg=1910,end=2017):
+def retech_delta(z_last, z):
+    '''
+    delta_t (equation 2): (z_t - z_t-1) / (z_t + z_t-1) for words used in 
+    either year, else 0. Dense, as long as the longer of the two.
+    '''
+    import numpy as np
+    n = max(len(z_last), len(z))
+    z_last, z = np.pad(z_last, (0, n-len(z_last))), np.pad(z, (0, n-len(z)))
+    both  = z_last + z
+    delta = np.zeros(n)
+    np.divide(z - z_last, both, out=delta, where=both > 0)
+    return delta
+
+
+def retech_scores(X, delta):
+    '''
+    RETech (equation 3): 100 x the average delta of the words a patent uses,
+    as one product of the binarized bags with delta.
+    '''
+    import numpy as np
+    B = X.copy()
+    B.data[:] = 1
+    return 100 * (B @ delta[:X.shape[1]]) / np.diff(X.indptr)
+
+
+def check_RETech_engines(beg=2011,end=2012,tol=1e-9):
+    '''
+    Run make_RETech() with the pandas and sparse engines on the same years 
+    and check they agree to tol. Returns the largest absolute difference.
+    '''
+    import os, tempfile
+    import pandas as pd
+    with tempfile.TemporaryDirectory() as tmp:
+        out = {}
+        for engine in ('pandas','sparse'):
+            make_RETech(os.path.join(tmp, engine + '.csv'), beg, end, engine=engine)
+            out[engine] = pd.read_csv(os.path.join(tmp, engine + '.csv'))
+    a, b = out['pandas'], out['sparse']
+    assert a[['pnum','year']].equals(b[['pnum','year']]), 'Engines scored different patents'
+    max_diff = (a.RETech - b.RETech).abs().max() if len(a) else 0.0
+    print('Patents: %i, largest difference: %g' % (len(a), max_diff))
+    assert max_diff <= tol, 'RETech engines differ by more than %g' % tol
+    return max_diff
+
+
+def make_breadth(outf,beg=1910,end=2017,engine='dense',max_memory=None,n_workers=1):
 	'''
+	Patent level breadth (1 - HHI of the nber classes its words specialize 
+	in). The word x class counts come from the year's YearStats (saved by 
+	clean_bags), the patents' words from the cleaned bags.
+	
+	engine='dense' (default) finds the specialized words on the (vocab x 
+	classes) count arrays (breadth_spec) and does the HHI on a (patents x 
+	classes) array (breadth_scores). 'pandas' is the original sort and 
+	groupby version, the output is the same (check_breadth_engines).
+	The dense engine scores each year in batches of patents that fit in 
+	max_memory bytes, n_workers years at once (see run_measures).
 	'''
 	
 	from tqdm import trange
@@ -1387,32 +3864,48 @@ def make_breadth(outf,beg=1910,end=2017):
 	import numpy as np
 	import os
 	
-	coarse_class = pd.read_csv('../data/patent_level_info/nber_CURRENT.csv',)
-	coarse_class.columns = ['pnum','coarse'] # to match the legacy var names below...
+	if engine == 'dense':
+		
+		# streams the bags a batch at a time, see BreadthMeasure
+		
+		run_measures([BreadthMeasure(outf)], beg, end, max_memory, n_workers)
+		return
 	
-	big_breadth = pd.DataFrame() # we will store results in this      
+	coarse_class = None # nber_CURRENT.csv, only loaded if a year has no YearStats
+	
+	big_breadth = AppendingCSV(outf) # we will store results in this, a year at a time
 	
 	for yyyy in trange(beg,end+1,desc='Creating Breadth...'): #1929,2011
 		
 		# load cleaned bagOwords and merge in bfh_codes
 		
-		batchdir = '../data/word_bags/descriptONLY/bags_cleaned_annualbatch_by_ayear/'
-		
-		bagOwords = pd.read_csv(batchdir + 'bag_ayear_'+str(yyyy)+'.csv',)
+		bagOwords = read_cleaned_bags(yyyy, columns=['pnum','word_index','count'])
 		bagOwords.columns = ['pnum','word_index','nwords']
 		
-		# get the word specializations
+		# for each word-cat combo, count the number of pats and total word count
+		# ncnt = # times that word is in those patents, ccnt = number of cats the 
+		# (saved by clean_bags in the year's YearStats, else from the bags)
 		
-		spec = (bagOwords.merge(coarse_class,how='inner',on='pnum')
+		stats = YearStats.load(yyyy)
+		if stats is not None:
+			tallies = stats.tallies()
+		else:
+			if coarse_class is None:
+				coarse_class = pd.DataFrame(dict(zip(['pnum','coarse'], load_nber_arrays()))) # legacy var names
+			tallies = (bagOwords.merge(coarse_class,how='inner',on='pnum')
+					.groupby(['word_index','coarse'])
+					.agg(ccnt=('coarse','count'),ncnt=('nwords','sum'))
+					.reset_index()
+					)
+		del stats
 		
-				# for each word-cat combo, count the number of pats and total word count
-				
-				.groupby(['word_index','coarse'])
-				.agg(ccnt=('coarse','count'),ncnt=('nwords','sum'))        # ncnt = # times that word is in those patents, ccnt = number of cats the 
+		# get the word specializations
+		
+		spec = (tallies
 				
 				# how many more times is a word used in one cat than the next most common cat? 
 				
-				.reset_index().sort_values(['word_index','ncnt','ccnt'])
+				.sort_values(['word_index','ncnt','ccnt'])
 				.assign(ng = lambda x: x.groupby('word_index')['ncnt'].pct_change(),
 						cg = lambda x: x.groupby('word_index')['ccnt'].pct_change(),
 						)
@@ -1455,13 +3948,360 @@ def make_breadth(outf,beg=1910,end=2017):
 		
 		# add to the main
 		
-		big_breadth = pd.concat([big_breadth,breadth],ignore_index=True)
+		big_breadth.write(breadth)
+		del bagOwords, tallies, spec, breadth # before the next year is loaded
 		
 	# done with loop
 	
-	big_breadth.to_csv(outf,index=False)
+	big_breadth.close()
+
+
+
+def breadth_spec(ccnt, ncnt):
+    '''
+    The nber class (column of the (vocab x classes) ccnt/ncnt tallies) that
+    each word specializes in, -1 if none. Same rule as the pandas engine of
+    make_breadth(): order a word's classes by (ncnt, ccnt, class), and the 
+    top one is its specialization if it beats the second by 50%+ in both 
+    ncnt and ccnt (or is the only one) and has 10+ patents.
+    '''
+    import numpy as np
+    
+    n_words, K = ccnt.shape
+    valid = ccnt > 0
+    
+    # one int64 sort key per cell (ranks of ncnt if the counts are too big)
+    # plus an always invalid column, so there are 2+ columns 
+    
+    c_max = int(ccnt.max(initial=0)) + 1
+    n_key = ncnt if int(ncnt.max(initial=0)) < 2**62 // (c_max*K) else np.unique(ncnt, return_inverse=True)[1].reshape(ncnt.shape)
+    key   = np.full((n_words, K+1), -1, dtype=np.int64)
+    key[:, :K] = np.where(valid, (n_key.astype(np.int64)*c_max + ccnt)*K + np.arange(K), -1)
+    
+    # top two cells per word (one = no second class)
+    
+    top2  = np.argpartition(key, K-1, axis=1)[:, -2:]
+    keys2 = np.take_along_axis(key, top2, axis=1)
+    first = keys2[:, 0] > keys2[:, 1]
+    top   = np.minimum(np.where(first, top2[:, 0], top2[:, 1]), K-1)
+    second = np.minimum(np.where(first, top2[:, 1], top2[:, 0]), K-1)
+    one   = keys2.min(axis=1) < 0
+    
+    rows = np.arange(n_words)
+    ncnt_top, ccnt_top = ncnt[rows, top], ccnt[rows, top]
+    ncnt_2nd, ccnt_2nd = ncnt[rows, second], ccnt[rows, second]
+    
+    # as pct_change: top / second - 1 (and 1 if there's no second)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ng = np.where(one, 1, ncnt_top / ncnt_2nd - 1)
+        cg = np.where(one, 1, ccnt_top / ccnt_2nd - 1)
+    
+    specialized = valid.any(axis=1) & (ng >= .5) & (cg >= .5) & (ccnt_top >= 10)
+    return np.where(specialized, top, -1)
+
+
+def breadth_scores(columns, spec, n_classes):
+    '''
+    (pnums, breadth) for the patents in (3, rows) bag columns (pnum, 
+    word_index, count) that use a specialized word (spec from breadth_spec):
+    1 - HHI of the patent's word counts across the classes its words 
+    specialize in. The squared shares are summed class by class with the 
+    same (Kahan) summation as pandas' groupby sum, so the output matches 
+    the pandas engine exactly.
+    '''
+    import numpy as np
+    
+    pnum, words, count = columns
+    spec = np.pad(spec, (0, max(0, int(words.max(initial=-1))+1 - len(spec))), constant_values=-1)
+    cls  = spec[words]
+    keep = cls >= 0
+    
+    pnums, row = np.unique(pnum[keep], return_inverse=True)
+    cell    = row.astype(np.int64)*n_classes + cls[keep]
+    size    = len(pnums)*n_classes
+    nwords  = np.bincount(cell, weights=count[keep], minlength=size).reshape(-1, n_classes)
+    present = np.bincount(cell, minlength=size).reshape(-1, n_classes) > 0
+    shares2 = (nwords / nwords.sum(axis=1, keepdims=True))**2
+    
+    hhi, comp = np.zeros(len(pnums)), np.zeros(len(pnums))
+    for k in range(n_classes):
+        y = shares2[:, k] - comp
+        t = hhi + y
+        comp = np.where(present[:, k], (t - hhi) - y, comp)
+        hhi  = np.where(present[:, k], t, hhi)
+    
+    return pnums, 1 - hhi
+
+
+def check_breadth_engines(beg=2010,end=2011):
+    '''
+    Run make_breadth() with the pandas and dense engines on the same years 
+    and check the outputs are identical.
+    '''
+    import os, tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        out = {}
+        for engine in ('pandas','dense'):
+            make_breadth(os.path.join(tmp, engine + '.csv'), beg, end, engine=engine)
+            with open(os.path.join(tmp, engine + '.csv')) as f:
+                out[engine] = f.read()
+    print('Rows: %i, identical: %s' % (out['pandas'].count('\n') - 1, out['pandas'] == out['dense']))
+    assert out['pandas'] == out['dense'], 'Breadth engines differ'
+
+
+class Measure:
+    """
+    A patent level text variable, computed from the cleaned bags by 
+    run_measures(), which streams each year's bags once and hands every 
+    batch to all the measures it runs. To add a variable: subclass, set 
+    name (the output is <name>.csv), override the hooks you need, and 
+    decorate the class with @register_measure so make_measures() runs it.
+    
+        begin(beg, end)         - the run will cover years beg-end
+        begin_year(yyyy, stats) - a year starts, stats is its YearStats 
+                                  (doc freqs, z_t sums, word x class 
+                                  tallies). Return False to skip its bags
+        consume_batch(pnum, word_index, count)
+                                - int32 arrays of a batch of the year's 
+                                  cleaned bags: whole patents, pnum order
+        end_year(yyyy)          - the year's batches are done
+        results()               - after the last year: closes the output 
+                                  and returns its path
+    
+    self.write(df) appends rows to the output csv. needs_nber = True if 
+    the measure uses stats.ccnt/ncnt (for years without saved YearStats, 
+    they're then computed from the bags and nber_CURRENT.csv).
+    """
+    
+    name       = None
+    needs_nber = False
+    
+    def __init__(self, outf, previous=None):
+        '''
+        outf:     the output csv
+        previous: this measure's output from an earlier run, if the measure
+                  can reuse parts of it
+        '''
+        import os
+        os.makedirs(os.path.dirname(outf) or '.', exist_ok=True)
+        self.outf     = outf
+        self.previous = previous
+        self.out      = AppendingCSV(outf)
+    
+    def begin(self, beg, end):
+        pass
+    
+    def begin_year(self, yyyy, stats):
+        pass
+    
+    def consume_batch(self, pnum, word_index, count):
+        pass
+    
+    def end_year(self, yyyy):
+        pass
+    
+    def write(self, df):
+        self.out.write(df)
+    
+    def results(self):
+        self.out.close()
+        return self.outf
+    
+    def __getstate__(self):
+        'For run_measures() workers, which get their own output file'
+        state = self.__dict__.copy()
+        state['out'] = None
+        return state
+
+
+MEASURES = {} # name: Measure subclass, what make_measures() runs
+
+MEASURE_ROW_BYTES = 160 # peak memory per row of a batch being scored (run_measures)
+
+
+def register_measure(cls):
+    'Class decorator, adds a Measure to MEASURES'
+    MEASURES[cls.name] = cls
+    return cls
+
+
+@register_measure
+class RETechMeasure(Measure):
+    """
+    RETech (equations 1-3 in the paper): 100 x the average delta_t of the 
+    words a patent uses, with delta_t from z_t-1 and z_t (YearStats). Rows 
+    of years whose inputs haven't changed since previous was written are 
+    copied from it (reusable_RETech_years).
+    """
+    
+    name = 'RETech'
+    
+    def begin(self, beg, end):
+        self.reuse  = reusable_RETech_years(self.previous, beg, end) if self.previous else {}
+        self.z_last = None
+    
+    def begin_year(self, yyyy, stats):
+        if yyyy in self.reuse:
+            self.out.copy(self.previous, *self.reuse[yyyy])
+            self.z = None
+            return False
+        if self.z_last is None:
+            self.z_last = year_z(yyyy-1)
+        self.yyyy  = yyyy
+        self.z     = stats.z
+        self.delta = retech_delta(self.z_last, self.z)
+    
+    def consume_batch(self, pnum, word_index, count):
+        import pandas as pd
+        pnums, X = bags_to_csr(pnum, word_index, count)
+        self.write(pd.DataFrame({'pnum':   pnums,
+                                 'RETech': retech_scores(X, self.delta),
+                                 'year':   self.yyyy}))
+    
+    def end_year(self, yyyy):
+        self.z_last = self.z # z(t) becomes z(t-1)
+
+
+@register_measure
+class BreadthMeasure(Measure):
+    """
+    Breadth: 1 - HHI of a patent's word counts across the nber classes its 
+    words specialize in (breadth_spec, breadth_scores)
+    """
+    
+    name       = 'Breadth'
+    needs_nber = True
+    
+    def begin_year(self, yyyy, stats):
+        self.spec      = breadth_spec(stats.ccnt, stats.ncnt)
+        self.n_classes = stats.ccnt.shape[1]
+    
+    def consume_batch(self, pnum, word_index, count):
+        import pandas as pd
+        pnums, breadth = breadth_scores((pnum, word_index, count), self.spec, self.n_classes)
+        self.write(pd.DataFrame({'pnum': pnums, 'breadth': breadth}))
+
+
+def run_measures(measures, beg, end, max_memory=None, n_workers=1):
+    '''
+    Compute the measures (Measure instances) for years beg-end in one 
+    streaming pass over the cleaned bags: each batch of a year's bags 
+    (iter_cleaned_bags) is read once and goes to every measure. Returns 
+    the measures' results().
+    
+    This is the second of two passes: the year's totals (z_t, the word x 
+    class tallies) come first, from its YearStats. Years cleaned before 
+    YearStats existed get theirs from an extra pass over their bags (with 
+    the class tallies only if a measure needs_nber).
+    
+    max_memory (bytes): batches are sized so the year's word_index arrays 
+    plus MEASURE_ROW_BYTES per row of the batch fit in it. None: a parquet 
+    row group (one clean_bags batch) at a time.
+    
+    n_workers > 1 does the years in parallel, each in a process pool 
+    worker with max_memory / n_workers: a year only needs its own bags and
+    stats (and z_t-1, from the prior year's stats). The workers write each
+    year to part files, which are appended to the outputs in year order, 
+    so the outputs are the same as with one worker.
+    '''
+    from tqdm import trange, tqdm
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+    
+    for measure in measures:
+        measure.begin(beg, end)
+    
+    desc = 'Making %s...' % ', '.join(m.name for m in measures)
+    
+    if n_workers == 1:
+        cache = {}
+        for yyyy in trange(beg,end+1,desc=desc):
+            measure_year(measures, yyyy, max_memory, cache)
+    
+    else:
+        PatentMeta().refresh() # before the workers map its arrays
+        with ProcessPoolExecutor(n_workers) as pool:
+            years = [pool.submit(measure_year_worker, measures, yyyy, max_memory and max_memory // n_workers,
+                                 ['%s.%i.part' % (m.outf, yyyy) for m in measures])
+                     for yyyy in range(beg,end+1)]
+            for year in tqdm(years, desc=desc):
+                for measure, part in zip(measures, year.result()):
+                    with open(part, 'rb') as f:
+                        header = f.readline()
+                    if header != b'\n': # else the year had no rows
+                        measure.out.copy(part, len(header), os.path.getsize(part))
+                    os.remove(part)
+    
+    return [measure.results() for measure in measures]
+
+
+def measure_year(measures, yyyy, max_memory=None, cache=None):
+    '''
+    One year of run_measures(). cache: a dict that keeps nber_CURRENT.csv 
+    between years, if it's needed.
+    '''
+    import logging
+    
+    stats = YearStats.load(yyyy, skip=('doc_freq','pnums'))
+    if stats is None:
+        cache = {} if cache is None else cache
+        if 'nber' not in cache:
+            cache['nber'] = load_nber_arrays() if any(m.needs_nber for m in measures) else None
+        stats = YearStats(yyyy, cache['nber'])
+        for columns in iter_cleaned_bags(yyyy): # row groups, like year_z(), so z_t is the same
+            stats.add(columns)
+    
+    # the stats, and z_t-1, delta_t and the specialized words 
+    max_rows = None
+    if max_memory is not None:
+        fixed    = stats.z_sum.nbytes*4 + stats.ccnt.nbytes + stats.ncnt.nbytes
+        max_rows = (max_memory - fixed) // MEASURE_ROW_BYTES
+        if max_rows < 10**5:
+            logging.info("max_memory is too small for %i, scoring 100000 rows at a time" % yyyy)
+            max_rows = 10**5
+    
+    active = [m for m in measures if m.begin_year(yyyy, stats) is not False]
+    if active:
+        for columns in iter_cleaned_bags(yyyy, max_rows):
+            if columns.shape[1]:
+                for measure in active:
+                    measure.consume_batch(*columns)
+    
+    for measure in measures:
+        measure.end_year(yyyy)
 
 
+def measure_year_worker(measures, yyyy, max_memory, parts):
+    '''
+    measure_year() in a run_measures() worker: the measures (copies, made 
+    after begin()) write to the part files instead of their outputs
+    '''
+    for measure, part in zip(measures, parts):
+        measure.out = AppendingCSV(part)
+    measure_year(measures, yyyy, max_memory)
+    for measure in measures:
+        measure.out.close()
+    return parts
+
+
+def make_measures(output_dir, beg=1910, end=2017, measures=None, previous_dir=None, max_memory=None,
+                  n_workers=1):
+    '''
+    Compute the registered measures (all of MEASURES, or the names in 
+    measures) for years beg-end in one pass over the cleaned bags 
+    (run_measures), as <output_dir>/<name>.csv: RETech.csv and Breadth.csv 
+    (for ship_outputs), plus any others that are registered.
+    
+    previous_dir : an earlier output dir, for measures that reuse unchanged
+                   years (RETech, see make_RETech)
+    max_memory :   bytes, bounds the batches the bags are scored in
+    n_workers :    years to do at once (same outputs, see run_measures)
+    '''
+    import os
+    return run_measures([MEASURES[name](os.path.join(output_dir, name + '.csv'),
+                                        os.path.join(previous_dir, name + '.csv') if previous_dir else None)
+                         for name in (measures or MEASURES)], beg, end, max_memory, n_workers)
+
 
 # def ship_outputs(in_retech,in_breadth,outf):
 def ship_outputs(output_dir_name):
@@ -1497,20 +4337,14 @@ def ship_outputs(output_dir_name):
                       header=0,
                       dtype={'pnum':np.int64,'Breadth':float})
         
-    # gyear
+    out = df1.merge(df2,on='pnum',how='outer',validate='1:1')
     
-    df3 = pd.read_csv('../data/patent_level_info/pat_dates_CURRENT.csv')
-    df3 = df3.drop('ayear',axis=1) # ayear is in the retech output
+    # gyear and nber 1 digit (ayear is in the retech output). pd's builtin 
+    # Int type allows for missing values
     
-    # nber 1 digit 
-    
-    df4 = pd.read_csv('../data/patent_level_info/nber_CURRENT.csv')
-    df4['nber'] = df4['nber'].astype('Int64') # pd's builtin Int type allows for missing values
-        
-    out = (df1.merge(df2,on='pnum',how='outer',validate='1:1')
-           .merge(df3,how='left',on='pnum',validate='1:1')
-           .merge(df4,how='left',on='pnum',validate='1:1')           
-           )
+    meta = PatentMeta().lookup(out.pnum)
+    out['gyear'] = meta.gyear.values
+    out['nber']  = meta.nber.values
     
     # key output!
     
@@ -1618,6 +4452,10 @@ def delete_recent_raw_bags():
     you can re-run the parsing code without worrying about errant patents 
     having some invalid word_index entries. 
     
+    Since word_index is journaled (see WordIndex), new ids are on disk 
+    before any bag uses them, so a crash no longer leaves such bags. This is 
+    only needed for bags written by older versions of the parser.
+    
     USAGE:
     
     Just set the date you want to delete from in the "delete_after" variable.
@@ -1629,7 +4467,6 @@ def delete_recent_raw_bags():
     stop # yes, this is meant to prevent the code from running any way but interactively.     
 
     import os , time, datetime, calendar
-    import pandas as pd
     from tqdm import tqdm
     
     # option 1: delete based on exact last time word_index file is modified
@@ -1648,24 +4485,16 @@ def delete_recent_raw_bags():
     min_year = 2010
     max_year = 2024
     
-    pnum_years_df = pd.read_csv('../data/patent_level_info/pat_dates_CURRENT.csv')\
-                   .query("ayear <= @max_year & ayear >= @min_year")   
-    pnum_years_df['stems'] = pnum_years_df['pnum'].astype(str).str.zfill(8).str[:4]
-    
-    stems = list({ stem for stem in pnum_years_df.stems.to_list()})
-    
     delete_these = []
-    base      = '../data/word_bags/descriptONLY/bags_raw_file_per_pat/'
     
-    for stem in tqdm(stems):
-        for pnum in pnum_years_df.query('stems == @stem').pnum.to_list():
+    for pnum in tqdm(PatentMeta().pnums_for_ayears(min_year, max_year)):
         
-            filep = base + stem + '/count_' + str(pnum) + '.csv'
-            
-            if os.path.exists(filep):
+        filep = raw_bag_path(pnum)
         
-                if     os.path.getctime(filep) > delete_after_ctime:
-                    delete_these.append(filep)
+        if os.path.exists(filep):
+    
+            if     os.path.getctime(filep) > delete_after_ctime:
+                delete_these.append(filep)
      
      
     print('Prepared to delete',len(delete_these),'files')
@@ -1673,6 +4502,11 @@ def delete_recent_raw_bags():
      
     for f in delete_these:
         os.remove(f)    
+    
+    # and tell the manifest these need parsing again
+    m = Manifest()
+    m.drop_bags([int(os.path.basename(f)[6:-4]) for f in delete_these])
+    m.close()
  
 
     
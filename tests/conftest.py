@@ -0,0 +1,39 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'code'))
+
+import pytest
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    'An empty <dir>/code to run in, so the ../data paths land in tmp_path'
+    os.makedirs(tmp_path / 'code')
+    monkeypatch.chdir(tmp_path / 'code')
+    return tmp_path
+
+
+@pytest.fixture
+def write_year(workdir):
+    '''
+    write_year(yyyy, rows, nber=None, stats=True): writes the cleaned bags 
+    of yyyy, rows = [(pnum, word_index, count), ...] in pnum order, and its 
+    YearStats (class tallies too if nber = (pnums, codes) is given)
+    '''
+    import numpy as np
+    import GPGutils
+
+    os.makedirs(GPGutils.CleanedBagWriter.batchdir, exist_ok=True)
+
+    def write_year(yyyy, rows, nber=None, stats=True):
+        columns = np.array(rows, dtype=np.int32).T.reshape(3, -1)
+        writer  = GPGutils.CleanedBagWriter(yyyy)
+        writer.write(columns)
+        writer.close()
+        if stats:
+            year_stats = GPGutils.YearStats(yyyy, nber)
+            year_stats.add(columns)
+            year_stats.save()
+
+    return write_year
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import GPGutils
+
+
+# class 1-4 patents: 100-139, 200-239, 300-339, 400-439 (and 140 is in 1 and 2)
+POOL = {k: list(range(100*k, 100*k + 40)) for k in (1, 2, 3, 4)}
+
+# word: {class: counts of the word in the first patents of the class}
+WORDS = {
+    900: {1: [1]*15, 2: [1]*10},                  # exactly 50% more, in ncnt and ccnt
+    901: {1: [1]*14, 2: [1]*10},                  # ccnt just short of 50% more
+    902: {3: [1]*10},                             # one class, exactly 10 patents
+    903: {3: [1]*9},                              # one class, 9 patents
+    904: {1: [2]*12, 2: [2]*12},                  # tied classes
+    905: {1: [2]*12, 2: [1]*24},                  # tied ncnt, ccnt breaks it
+    906: {1: [1]*28 + [2]*2, 2: [2]*9 + [3], 3: [1]*21}, # 2nd place is a tie in ncnt: 
+}                                                 # class 3 (more patents) is 2nd
+SPEC = {900: 0, 901: -1, 902: 2, 903: -1, 904: -1, 905: -1, 906: -1}
+
+
+def tie_heavy_year(write_year, yyyy, stats):
+    'The WORDS, plus random words with counts of 1 or 2 (lots of ties)'
+    rng   = np.random.default_rng(yyyy)
+    cells = {}
+    for word, classes in WORDS.items():
+        for k, counts in classes.items():
+            for pnum, count in zip(POOL[k], counts):
+                cells[pnum, word] = count
+    for pnum in sum(POOL.values(), []) + [140]:
+        for word in rng.choice(40, size=8, replace=False):
+            cells[pnum, word] = rng.integers(1, 3)
+    
+    nber = sorted([(p, float(k)) for k, pnums in POOL.items() for p in pnums] + [(140, 1.0), (140, 2.0)])
+    os.makedirs('../data/patent_level_info', exist_ok=True)
+    os.makedirs('../out', exist_ok=True)
+    pd.DataFrame(nber, columns=['pnum','nber']).to_csv('../data/patent_level_info/nber_CURRENT.csv', index=False)
+    
+    rows = [(pnum, word, count) for (pnum, word), count in sorted(cells.items())]
+    write_year(yyyy, rows, GPGutils.load_nber_arrays(), stats=stats)
+    return np.array(rows, dtype=np.int32).T
+
+
+@pytest.mark.parametrize('stats', [True, False])
+def test_dense_matches_pandas(write_year, stats):
+    for yyyy in (2001, 2002):
+        tie_heavy_year(write_year, yyyy, stats)
+    GPGutils.make_breadth('../out/pandas.csv', 2001, 2002, engine='pandas')
+    GPGutils.make_breadth('../out/dense.csv', 2001, 2002, engine='dense')
+    with open('../out/pandas.csv') as a, open('../out/dense.csv') as b:
+        assert a.read() == b.read()
+
+
+def test_spec_and_scores(write_year):
+    columns = tie_heavy_year(write_year, 2001, stats=True)
+    stats   = GPGutils.YearStats.load(2001)
+    assert stats.classes.tolist() == [1, 2, 3, 4]
+    
+    spec = GPGutils.breadth_spec(stats.ccnt, stats.ncnt)
+    assert {word: spec[word] for word in SPEC} == SPEC
+    
+    GPGutils.make_breadth('../out/pandas.csv', 2001, 2001, engine='pandas')
+    pandas = pd.read_csv('../out/pandas.csv')
+    pnums, breadth = GPGutils.breadth_scores(columns, spec, len(stats.classes))
+    assert pnums.tolist() == pandas.pnum.tolist()
+    assert breadth.tolist() == pandas.breadth.tolist() # exactly
@@ -0,0 +1,99 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import GPGutils
+
+
+def bags(*rows):
+    return np.array(rows, dtype=np.int32).T.reshape(3, -1)
+
+
+@pytest.mark.parametrize('write_csv', [False, True])
+def test_empty_batches_are_skipped(workdir, write_csv):
+    os.makedirs(GPGutils.CleanedBagWriter.batchdir)
+    writer = GPGutils.CleanedBagWriter(2001, write_csv=write_csv)
+    writer.write(bags())
+    writer.write(bags((1, 5, 1), (1, 6, 2), (2, 7, 1)))
+    writer.write(bags())
+    writer.close()
+    if write_csv:
+        os.remove(writer.path)
+
+    expected = [[[1, 1], [5, 6], [1, 2]], [[2], [7], [1]]]
+    assert [c.tolist() for c in GPGutils.iter_cleaned_bags(2001)] == expected
+    assert [c.tolist() for c in GPGutils.iter_cleaned_bags(2001, max_rows=1)] == expected
+
+
+def test_empty_first_chunk(workdir):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # a zero-row row group, as written before CleanedBagWriter skipped them
+    os.makedirs(GPGutils.CleanedBagWriter.batchdir)
+    schema = pa.schema([(c, pa.int32()) for c in GPGutils.RawBagStore.COLUMNS])
+    with pq.ParquetWriter(os.path.join(GPGutils.CleanedBagWriter.batchdir, 'bag_ayear_2001.parquet'), schema) as f:
+        for columns in (bags(), bags((3, 5, 1), (4, 6, 2))):
+            f.write_table(pa.Table.from_arrays(list(columns), schema=schema))
+
+    assert np.concatenate(list(GPGutils.iter_cleaned_bags(2001)), axis=1).tolist() == [[3, 4], [5, 6], [1, 2]]
+
+
+def write_inputs(pnums, nber):
+    'pat_dates and nber csvs for pnums (all applied for in 2001), nber: {pnum: code or None}'
+    os.makedirs('../data/patent_level_info', exist_ok=True)
+    with open('../data/patent_level_info/pat_dates_CURRENT.csv', 'w') as f:
+        f.write('pnum,ayear,gyear\n' + ''.join('%i,2001,2003\n' % p for p in pnums))
+    with open('../data/patent_level_info/nber_CURRENT.csv', 'w') as f:
+        f.write('pnum,nber\n' + ''.join('%i,%s\n' % (p, '' if c is None else '%.1f' % c) 
+                                        for p, c in nber.items()))
+    for fname in os.listdir('../data/patent_level_info'): # new mtimes, even within a tick
+        os.utime(os.path.join('../data/patent_level_info', fname), ns=(time.time_ns(),)*2)
+
+
+def add_raw_bags(pnums, name):
+    'Raw bags: word 1 in every patent (a stopword), and 20 others each'
+    manifest = GPGutils.Manifest()
+    store    = GPGutils.RawBagStore(manifest)
+    bags     = [(p, np.array([1] + sorted({2 + (p*7 + j) % 200 for j in range(20)}), dtype=np.int32),
+                 np.arange(1, 22, dtype=np.int32)) for p in pnums]
+    bag_path = os.path.join(GPGutils.RawBagStore.packed_dir, '2001', name + '.npy')
+    for pnum, rows in store.write_shard(bag_path, bags).items():
+        manifest.record_bag(pnum, 'parsed', 2024, bag_path, *rows)
+    manifest.close()
+
+
+@pytest.mark.parametrize('fill_in', [False, True])
+def test_incremental_clean_matches_full(workdir, monkeypatch, fill_in):
+    os.makedirs('../data/word_bags/descriptONLY/wordspace')
+    os.makedirs('../inputs')
+    with open('../data/word_bags/word_index.csv', 'w') as f:
+        f.write(''.join('"word%i",%i\n' % (i, i) for i in range(1, 300)))
+    with open('../inputs/bad_ocr_words.csv', 'w') as f:
+        f.write('299\n')
+    
+    old, late = range(100, 160), range(160, 170)
+    codes     = {p: (None if p % 3 == 0 else 1 + p % 4) for p in range(100, 170)}
+    write_inputs(old, codes)
+    add_raw_bags(old, 'first')
+    GPGutils.clean_bags(2001, 2001)
+    
+    # late grants, and maybe update_pat_nber_class() fills in the missing codes 
+    write_inputs(list(old) + list(late), {p: (c or 2) if fill_in else c for p, c in codes.items()})
+    add_raw_bags(late, 'second')
+    updated = []
+    update  = GPGutils.update_cleaned_year
+    monkeypatch.setattr(GPGutils, 'update_cleaned_year', 
+                        lambda *args: updated.append(update(*args)) or updated[-1])
+    GPGutils.clean_bags(2001, 2001, incremental=True)
+    incremental = GPGutils.YearStats.load(2001)
+    assert (updated[0] is None) == fill_in # changed codes: cleaned in full
+    
+    GPGutils.clean_bags(2001, 2001)
+    full = GPGutils.YearStats.load(2001)
+    assert full.classes.tolist() == incremental.classes.tolist() == [1, 2, 3, 4]
+    assert np.array_equal(incremental.ccnt, full.ccnt)
+    assert np.array_equal(incremental.ncnt, full.ncnt)
+    assert incremental.nber_sha1 == full.nber_sha1
@@ -0,0 +1,157 @@
+import asyncio
+import csv
+import logging
+import os
+import time
+from collections import Counter
+
+import aiohttp
+import pytest
+
+import GPGutils
+
+
+class FakeServer:
+    '''
+    Stands in for ClientSession.get. respond(pnum, n) gives the (status, 
+    headers) of the n-th request (from 1) for pnum, delay how long each 
+    response takes (seconds).
+    '''
+    
+    def __init__(self, respond=lambda pnum, n: (200, {}), delay=0):
+        self.respond  = respond
+        self.delay    = delay
+        self.requests = [] # (pnum, time the request started)
+        self.answered = {} # pnum: [time of each response]
+    
+    def get(self, session, url, **kwargs):
+        pnum = int(url.rsplit('US', 1)[1])
+        self.requests.append((pnum, time.monotonic()))
+        n = sum(p == pnum for p, _ in self.requests)
+        return FakeResponse(self, pnum, *self.respond(pnum, n))
+    
+    def counts(self):
+        return Counter(pnum for pnum, _ in self.requests)
+
+
+class FakeResponse:
+    
+    def __init__(self, server, pnum, status, headers):
+        self.server  = server
+        self.pnum    = pnum
+        self.status  = status
+        self.headers = headers
+    
+    async def __aenter__(self):
+        await asyncio.sleep(self.server.delay)
+        self.server.answered.setdefault(self.pnum, []).append(time.monotonic())
+        return self
+    
+    async def __aexit__(self, *exc):
+        return False
+    
+    async def read(self):
+        return b'<html>%i</html>' % self.pnum
+
+
+@pytest.fixture
+def server(workdir, monkeypatch):
+    'A FakeServer, and a retry ledger with short backoffs (1, 2 seconds, then give up)'
+    fake = FakeServer()
+    monkeypatch.setattr(aiohttp.ClientSession, 'get', lambda session, url, **kw: fake.get(session, url, **kw))
+    
+    class FastLedger(GPGutils.RetryLedger):
+        def __init__(self, path):
+            super().__init__(path, base_delay=1, max_attempts=3)
+    
+    monkeypatch.setattr(GPGutils, 'RetryLedger', FastLedger)
+    return fake
+
+
+def write_ledger(rows):
+    'rows: (pnum, attempts, next_try)'
+    os.makedirs('../data', exist_ok=True)
+    with open('../data/html_retry_ledger.csv', 'w', newline='') as f:
+        f.write('pnum,attempts,next_try,last_status\n' + ''.join('%i,%i,%f,503\n' % row for row in rows))
+
+
+def read_ledger():
+    with open('../data/html_retry_ledger.csv', newline='') as f:
+        return {int(row['pnum']): row for row in csv.DictReader(f)}
+
+
+def test_aimd_controller():
+    controller = GPGutils.AIMDController(start=10)
+    controller.on_congestion(retry_after=2)
+    assert controller.limit == 5
+    assert controller.pause_until == pytest.approx(time.monotonic() + 2, abs=0.5)
+    controller.on_congestion() # same overload, within the cooldown
+    assert controller.limit == 5
+    for _ in range(20):
+        controller.on_success(latency=0.1)
+    assert controller.limit > 5
+    controller.on_success(latency=60) # slow: no increase
+    
+    assert GPGutils.AIMDController.parse_retry_after('3') == 3
+    assert GPGutils.AIMDController.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert GPGutils.AIMDController.parse_retry_after('soon') is None
+
+
+def test_each_pnum_requested_once(server):
+    # 7 and 8 failed before and are ready to retry, 9 is backing off, 99 
+    # is from some other run (not asked for here)
+    future = time.time() + 3600
+    write_ledger([(7, 1, 0), (8, 1, 0), (9, 1, future), (99, 1, 0)])
+    server.delay = 0.5 # still in flight when the producer looks for due retries
+    
+    GPGutils.download_gpg_pages([5, 6, 7, 8, 9])
+    
+    assert server.counts() == {5: 1, 6: 1, 7: 1, 8: 1}
+    assert sorted(read_ledger()) == [9, 99]
+    assert GPGutils.HTMLArchive(f'../data/html_DL_in_{time.localtime().tm_year}').read(7) == b'<html>7</html>'
+
+
+def test_503_retry_after_slows_down(server):
+    server.respond = lambda pnum, n: (503, {'Retry-After': '1'}) if (pnum, n) == (1, 1) else (200, {})
+    server.delay   = 0.2
+    
+    GPGutils.download_gpg_pages(range(1, 31))
+    
+    # the first 10 went out at once (start_concurrency), the 503 came back 
+    # right away: later requests wait out the Retry-After, and go out in a 
+    # halved window (5, grown back a little by the 9 successes in flight)
+    first_503 = server.answered[1][0] - 0.2
+    later     = sorted(t for _, t in server.requests[10:])
+    assert later[0] >= first_503 + 0.9
+    assert sum(t < later[0] + 0.1 for t in later) < 10
+    assert server.counts()[1] == 2 # retried after its backoff, in this run
+    assert set(server.counts()) == set(range(1, 31))
+
+
+def test_failures_are_kept_and_retried_after_backoff(server):
+    server.respond = lambda pnum, n: {(3, 1): (500, {})}.get((pnum, n), (404 if pnum == 4 else 200, {}))
+    
+    GPGutils.download_gpg_pages([2, 3, 4])
+    
+    counts = server.counts()
+    assert counts == {2: 1, 3: 2, 4: 3}
+    
+    # 3 came back after its 1 second backoff, 4 backed off 1 then 2 seconds 
+    times = {pnum: [t for p, t in server.requests if p == pnum] for pnum in counts}
+    assert times[3][1] - times[3][0] >= 1
+    assert times[4][2] - times[4][1] >= 2
+    
+    ledger = read_ledger()
+    assert list(ledger) == [4] # given up on, left for a look at last_status
+    assert (ledger[4]['attempts'], ledger[4]['last_status']) == ('3', '404')
+
+
+def test_watchdog_stops_a_stalled_run(server, caplog):
+    server.delay = 25 # under the 30 second request timeout
+    
+    start = time.monotonic()
+    with caplog.at_level(logging.ERROR, logger='patent_scraper'):
+        GPGutils.download_gpg_pages([1, 2, 3], batch_size=1) # 2 seconds per batch
+    
+    assert time.monotonic() - start < 10
+    assert 'Batch progress deadline reached' in caplog.text
@@ -0,0 +1,44 @@
+import os
+import time
+
+
+import GPGutils
+
+
+def write_csv(name, text):
+    os.makedirs('../data/patent_level_info', exist_ok=True)
+    path = os.path.join('../data/patent_level_info', name)
+    with open(path, 'w') as f:
+        f.write(text)
+    os.utime(path, ns=(time.time_ns(),)*2) # a new mtime, even within a tick
+
+
+def test_lookup_and_selection(workdir):
+    write_csv('pat_dates_CURRENT.csv', 'pnum,ayear,gyear\n12,2001,2003\n5,2000,2002\n30,2001,2004\n')
+    write_csv('nber_CURRENT.csv', 'pnum,nber\n30,4.0\n5,\n12,2.0\n12,1.0\n')
+    meta = GPGutils.PatentMeta()
+    
+    assert meta.pnums_for_ayears(2001, 2001).tolist() == [12, 30]
+    assert meta.pnums_for_ayears(2000, 2005).tolist() == [5, 12, 30]
+    assert meta.dates().values.tolist() == [[5, 2000, 2002], [12, 2001, 2003], [30, 2001, 2004]]
+    
+    pnums, codes = GPGutils.load_nber_arrays()
+    assert pnums.tolist() == [12, 12, 30] and codes.tolist() == [2.0, 1.0, 4.0]
+    
+    out = meta.lookup([30, 5, 7, 12, 10**9])
+    assert out.astype(object).where(out.notna(), None).values.tolist() == [
+        [30, 2001, 2004, 4], [5, 2000, 2002, None], [7, None, None, None], 
+        [12, 2001, 2003, 2], [10**9, None, None, None]]
+
+
+def test_rebuilt_when_the_csv_changes(workdir):
+    write_csv('pat_dates_CURRENT.csv', 'pnum,ayear,gyear\n12,2001,2003\n')
+    assert GPGutils.PatentMeta().pnums_for_ayears(2001, 2001).tolist() == [12]
+    write_csv('pat_dates_CURRENT.csv', 'pnum,ayear,gyear\n12,2001,2003\n14,2001,2003\n')
+    assert GPGutils.PatentMeta().pnums_for_ayears(2001, 2001).tolist() == [12, 14]
+
+
+def test_lookup_without_nber(workdir):
+    write_csv('pat_dates_CURRENT.csv', 'pnum,ayear,gyear\n12,2001,2003\n')
+    out = GPGutils.PatentMeta().lookup([12])
+    assert out.ayear.tolist() == [2001] and out.nber.isna().all()
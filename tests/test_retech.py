@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import GPGutils
+
+
+def synthetic_years(write_year, stats):
+    rng = np.random.default_rng(0)
+    for yyyy, (pnums, words) in {2000: (range(1, 40),   range(0, 60)),
+                                  2001: (range(40, 80),  range(30, 90)),
+                                  2002: (range(80, 100), range(200, 260)), # no words in common with 2001
+                                  2003: (range(100, 130), range(220, 280))}.items():
+        rows = []
+        for pnum in pnums:
+            for word in sorted(rng.choice(words, size=rng.integers(1, 15), replace=False)):
+                rows.append((pnum, word, rng.integers(1, 6)))
+        if yyyy == 2003:
+            rows += [(130, 500, 2), (130, 501, 1)] # only words 2002 didn't use
+        write_year(yyyy, rows, stats=stats)
+
+
+@pytest.mark.parametrize('stats', [True, False])
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_sparse_matches_pandas(write_year, stats, n_workers):
+    synthetic_years(write_year, stats)
+    GPGutils.make_RETech('../out/pandas.csv', 2001, 2003, engine='pandas')
+    GPGutils.make_RETech('../out/sparse.csv', 2001, 2003, engine='sparse', n_workers=n_workers)
+    a, b = pd.read_csv('../out/pandas.csv'), pd.read_csv('../out/sparse.csv')
+    
+    assert a[['pnum','year']].equals(b[['pnum','year']])
+    assert a.year.unique().tolist() == [2001, 2002, 2003]
+    assert np.abs(a.RETech - b.RETech).max() <= 1e-9
+    
+    # every word of 2002 is new, so delta = 1 for all of them, same for 130 in 2003
+    assert np.allclose(b.RETech[b.year == 2002], 100)
+    assert b.RETech[b.pnum == 130].item() == pytest.approx(100)
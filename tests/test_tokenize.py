@@ -0,0 +1,46 @@
+from collections import Counter
+
+import pytest
+
+import GPGutils
+
+
+def tokenize_reference(text):
+    'The original parse_HTML tokenizer, which tokenize() replaces'
+    return ''.join([i.lower() if (ord(i) <= 90 and ord(i)>=65) or (ord(i) >= 97 and ord(i) <= 122 ) 
+                    else ' '  
+                    for i in text
+                    ]).split()
+
+
+EDGE_CASES = ['', ' ', 'A', 'z', 'AbC dEf', 'x1y2z3', '@[`{', 'AZaz', 'AZ[az',
+              'tab\tnew\nline\r\x0b\x0c\x1c\x1f\x85\xa0nbsp',
+              'caf\xe9 na\xefve \xdfstra\xdfe ﬁle', # accents, sharp s, fi ligature
+              'İstanbul Kelvin ſlong s', # lower() to ASCII letters!
+              'snow☃man emoji\U0001F600end', 'surrogate\ud800pair',
+              'ΑΒΓ абв 中文 mixed',
+              'semi-conductor, (e.g., 5°C) H2O — etc...',
+              ''.join(map(chr, range(0x250)))] # every char up to 0x250, in one text
+
+
+@pytest.mark.parametrize('text', EDGE_CASES)
+def test_tokenize(text):
+    assert GPGutils.tokenize(text) == tokenize_reference(text)
+
+
+def test_tokenize_batch():
+    assert GPGutils.tokenize_batch(EDGE_CASES) == [tokenize_reference(text) for text in EDGE_CASES]
+
+
+def test_count_words_batch():
+    vocab, bags = GPGutils.count_words_batch(EDGE_CASES)
+    id_to_word  = list(vocab)
+    for (ids, counts), text in zip(bags, EDGE_CASES):
+        words = tokenize_reference(text)
+        assert [id_to_word[i] for i in ids] == list(dict.fromkeys(words)) # order of first appearance
+        assert dict(zip([id_to_word[i] for i in ids], counts.tolist())) == Counter(words)
+    
+    # passing the vocab back in continues it
+    more, bags = GPGutils.count_words_batch(['zzz new words caf'], dict(vocab))
+    assert list(more)[:len(vocab)] == list(vocab)
+    assert [list(more)[i] for i in bags[0][0]] == ['zzz', 'new', 'words', 'caf']